@@ -0,0 +1,472 @@
+#!/usr/bin/python3
+
+"""Benchmarks of build planning and distroless-builder on a synthetic tree.
+
+The tree of images, files, packages and ELF libraries is generated from a fixed
+seed, podman, buildah and rpm are replaced by the shims in benchmarks/bin, so
+numbers of different commits on the same machine can be compared.
+"""
+
+import argparse
+import gc
+import importlib.util
+import json
+import os
+import platform
+import random
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCHMARKS_DIR.parent
+BIN_DIR = BENCHMARKS_DIR / "bin"
+BUILD_PY = REPO_DIR / "build.py"
+DISTROLESS_BUILDER_PY = REPO_DIR / "org/alt/distroless-builder/distroless-builder.py"
+BRANCHES = ["p9", "p10", "sisyphus"]
+ARCHES = ["amd64", "386", "arm64", "arm", "ppc64le"]
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_elf(needed, runpath=None):
+    """Minimal little-endian x86_64 ELF file with a dynamic section."""
+    strings = b"\0"
+    dynamic = []
+    for name in needed:
+        dynamic.append((1, len(strings)))
+        strings += name.encode() + b"\0"
+    if runpath is not None:
+        dynamic.append((29, len(strings)))
+        strings += runpath.encode() + b"\0"
+    phoff = 64
+    dynamic_offset = phoff + 2 * 56
+    strtab_offset = dynamic_offset + (len(dynamic) + 2) * 16
+    size = strtab_offset + len(strings)
+    dynamic += [(5, strtab_offset), (0, 0)]
+
+    header = b"\x7fELF" + bytes([2, 1, 1]) + bytes(9)
+    header += struct.pack(
+        "<HHIQQQIHHHHHH", 3, 62, 1, 0, phoff, 0, 0, 64, 56, 2, 0, 0, 0
+    )
+    load = struct.pack("<IIQQQQQQ", 1, 5, 0, 0, 0, size, size, 0x1000)
+    dynamic_phdr = struct.pack(
+        "<IIQQQQQQ",
+        2,
+        6,
+        dynamic_offset,
+        dynamic_offset,
+        dynamic_offset,
+        len(dynamic) * 16,
+        len(dynamic) * 16,
+        8,
+    )
+    data = b"".join(struct.pack("<qQ", tag, value) for tag, value in dynamic)
+    return header + load + dynamic_phdr + data + strings
+
+
+class SyntheticTree:
+    """Images in org/, files in root/, packages in rpmdb/ and ELFs in elfroot/."""
+
+    def __init__(self, path: Path, images, files, seed=0):
+        self.path = path
+        self.random = random.Random(seed)
+        self.org_dir = path / "org"
+        self.root = path / "root"
+        self.rpm_db = path / "rpmdb"
+        self.elf_root = path / "elfroot"
+        self.files = []
+        self.packages = []
+        self.binaries = []
+        self.make_images(images)
+        self.make_files(files)
+        self.make_elfs(max(files // 100, 10))
+
+    def write(self, path: Path, text):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+
+    def make_images(self, count):
+        self.write(
+            self.org_dir / "alt/base/Dockerfile.template",
+            "FROM {{ registry }}{{ alt_image }}:{{ branch }}\n\n"
+            '{{ install_pakages("glibc-locales", "tzdata") }}\n',
+        )
+        self.write(
+            self.org_dir / "alt/distroless-builder/Dockerfile.template",
+            "FROM {{ registry }}{{ organization }}/base:{{ branch }}\n\n"
+            '{{ install_pakages("python3", "rpm") }}\n',
+        )
+        self.write(
+            self.org_dir / "alt/distroless-static/distroless.toml",
+            'from = "scratch"\nfiles = ["/etc/os-release"]\n',
+        )
+        templates = []
+        distrolesses = ["alt/distroless-static"]
+        for i in range(count):
+            name = f"bench/image-{i:04}"
+            if i % 4 == 3:
+                parent = self.random.choice(distrolesses)
+                packages = [
+                    f"package-{self.random.randrange(100):03}" for _ in range(5)
+                ]
+                from_ = parent.replace("bench/", "{{ organization }}/")
+                spec = [
+                    f'from = "{{{{ registry }}}}{from_}:{{{{ branch }}}}"',
+                    "builder-install-packages = [",
+                    *[f'    "{p}",' for p in packages],
+                    '    \'{{if_branches(["p10"], "glibc-nss")}}\',',
+                    '    \'{{if_arches(["amd64", "arm64"], "libgcc1")}}\',',
+                    "]",
+                    f"packages = {json.dumps(packages[:3])}",
+                    f'files = ["/usr/bin/image-{i:04}", "/etc/image-{i:04}/*"]',
+                    r'exclude-regexes = ["/usr/share/doc/", ".*\\.pyc$"]',
+                    f'cmd = ["/usr/bin/image-{i:04}"]',
+                    'timezone = "Europe/Moscow"',
+                ]
+                self.write(
+                    self.org_dir / name / "distroless.toml", "\n".join(spec) + "\n"
+                )
+                distrolesses.append(name)
+            else:
+                parent = self.random.choice(templates) if templates else "alt/base"
+                organization = parent.split("/")[0]
+                if organization == "bench":
+                    organization = "{{ organization }}"
+                packages = " ".join(
+                    f'"package-{self.random.randrange(100):03}"' for _ in range(4)
+                )
+                lines = [
+                    f"FROM {{{{ registry }}}}{organization}/{parent.split('/')[1]}"
+                    ":{{ branch }}",
+                    "",
+                    "MAINTAINER alt-cloud",
+                    "",
+                    f"{{{{ install_pakages({packages.replace(' ', ', ')}) }}}}",
+                    "",
+                    *[f"RUN echo step {j} > /etc/image-{i:04}.{j}" for j in range(5)],
+                    "",
+                    f'CMD ["/usr/bin/image-{i:04}"]',
+                ]
+                self.write(
+                    self.org_dir / name / "Dockerfile.template", "\n".join(lines) + "\n"
+                )
+                templates.append(name)
+
+    def make_files(self, count):
+        for i in range(count):
+            file = self.root / f"usr/share/bench/d{i // 500:03}/f{i:05}.txt"
+            if i % 500 == 0:
+                file.parent.mkdir(parents=True, exist_ok=True)
+            if i % 50 == 49:
+                file.symlink_to(f"f{i - 1:05}.txt")
+            else:
+                file.write_text(f"file {i}\n")
+            self.files.append(file.as_posix())
+        self.rpm_db.mkdir(parents=True, exist_ok=True)
+        for i in range(100):
+            package = f"package-{i:03}"
+            files = self.random.sample(self.files, min(200, len(self.files)))
+            (self.rpm_db / package).write_text("".join(f + "\n" for f in files))
+            self.packages.append(package)
+
+    def make_elfs(self, count):
+        lib_dir = self.elf_root / "usr/lib64"
+        bin_dir = self.elf_root / "usr/bin"
+        lib_dir.mkdir(parents=True)
+        bin_dir.mkdir(parents=True)
+        for i in reversed(range(count)):
+            needed = [
+                f"libbench{j}.so.1"
+                for j in self.random.sample(range(i + 1, count), min(3, count - i - 1))
+            ]
+            runpath = "$ORIGIN" if i % 10 == 0 else None
+            (lib_dir / f"libbench{i}.so.1.0").write_bytes(make_elf(needed, runpath))
+            (lib_dir / f"libbench{i}.so.1").symlink_to(f"libbench{i}.so.1.0")
+        for i in range(count // 2):
+            needed = [f"libbench{j}.so.1" for j in self.random.sample(range(count), 4)]
+            (bin_dir / f"bin{i}").write_bytes(make_elf(needed))
+            self.binaries.append(f"/usr/bin/bin{i}")
+
+
+class Benchmarks:
+    def __init__(self, tree: SyntheticTree):
+        self.tree = tree
+        self.build = load_module("build", BUILD_PY)
+        self.distroless_builder = load_module(
+            "distroless_builder", DISTROLESS_BUILDER_PY
+        )
+        self.catalog = self.build.ImageCatalog()
+
+    def builders(self, **kwargs):
+        build = self.build
+        return [
+            build.DockerBuilder(
+                "registry.altlinux.org",
+                branch,
+                organization,
+                None,
+                "p10",
+                True,
+                build.ImagesInfo(),
+                build.Tasks(None),
+                build.Tags(None, "p10"),
+                catalog=self.catalog,
+                **kwargs,
+            )
+            for organization in self.catalog.organizations
+            for branch in BRANCHES
+        ]
+
+    def bench_image_catalog(self):
+        return self.build.ImageCatalog
+
+    def bench_render_dockerfiles(self):
+        builders = self.builders()
+
+        def run():
+            self.build.compile_template.cache_clear()
+            for db in builders:
+                db.render_dockerfiles()
+
+        return run
+
+    def bench_load_distrolesses(self):
+        builders = self.builders()
+
+        def run():
+            for db in builders:
+                db.load_distrolesses()
+
+        return run
+
+    def bench_get_requires(self):
+        builders = self.builders()
+
+        def run():
+            self.build.compile_template.cache_clear()
+            for db in builders:
+                db.get_requires_graph()
+
+        return run
+
+    def bench_get_requires_cached(self):
+        requires_cache = self.build.RequiresCache(Path("requires.json"))
+        builders = self.builders(requires_cache=requires_cache)
+        for db in builders:
+            db.get_requires_graph()
+
+        def run():
+            for db in builders:
+                db.get_requires_graph()
+
+        return run
+
+    def bench_get_build_order(self):
+        builders = self.builders()
+
+        def run():
+            for db in builders:
+                list(db.get_build_order())
+
+        return run
+
+    def bench_render_arch_branch(self):
+        builders = self.builders()
+
+        def run():
+            # renders are memoized, so start with not rendered specs
+            for db in builders:
+                db.load_distrolesses()
+                for distroless in db.distrolesses.values():
+                    distroless.render_arches(ARCHES, db.branch)
+
+        return run
+
+    def bench_dl_add(self):
+        dl = self.distroless_builder.DL(Path("dl-file.list"))
+        files = [f"{self.tree.root}/usr/share/bench/d00*/f*0.txt"]
+        file_list = Path("file-list")
+        file_list.write_text("".join(f + "\n" for f in self.tree.files[::3]))
+
+        def run():
+            dl.clean()
+            dl.add(
+                files,
+                [file_list],
+                self.tree.packages,
+                regexes=[f"{self.tree.root}/usr/share/bench/d001/", r".*7\.txt$"],
+            )
+
+        return run
+
+    def bench_dl_tar(self):
+        dl = self.distroless_builder.DL(Path("dl-file.list"))
+        dl.clean()
+        dl.add(self.tree.files, [], [], is_glob=False)
+
+        def run():
+            dl.tar("distroless.tar", [r".*7\.txt$"], reproducible=True)
+
+        return run
+
+    def bench_library_files(self):
+        def run():
+            self.distroless_builder.library_files(
+                self.tree.binaries, self.tree.elf_root.as_posix()
+            )
+
+        return run
+
+    def bench_build_dry_run(self):
+        cmd = [
+            sys.executable,
+            BUILD_PY,
+            "--organizations",
+            "bench",
+            "--branches",
+            "p10",
+            "--dry-run",
+            "--build-cache",
+            "--stages",
+            "render_dockerfiles",
+            "build",
+            "--jobs",
+            "4",
+        ]
+
+        def run():
+            subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
+
+        return run
+
+    def run(self, name, repeat):
+        func = getattr(self, f"bench_{name}")()
+        times = []
+        for _ in range(repeat):
+            gc.collect()
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        return {"min": min(times), "median": statistics.median(times)}
+
+
+def git_revision():
+    proc = subprocess.run(
+        ["git", "-C", REPO_DIR, "describe", "--always", "--dirty"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    return proc.stdout.strip() or None
+
+
+def parse_args(names):
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        default=names,
+        metavar="BENCHMARK",
+        help=f"benchmarks to run, of: {', '.join(names)}",
+    )
+    parser.add_argument(
+        "--images",
+        type=int,
+        default=300,
+        help="number of synthetic images",
+    )
+    parser.add_argument(
+        "--files",
+        type=int,
+        default=20000,
+        help="number of synthetic files",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="number of runs of every benchmark",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="seed of the synthetic tree",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=Path,
+        help="write results as JSON to OUTPUT",
+    )
+    parser.add_argument(
+        "--compare",
+        type=Path,
+        help="compare with results of an earlier run written with --output",
+    )
+    args = parser.parse_args()
+    if unknown := set(args.benchmarks) - set(names):
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main():
+    names = [n[len("bench_") :] for n in dir(Benchmarks) if n.startswith("bench_")]
+    args = parse_args(names)
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+    output = args.output.absolute() if args.output else None
+    os.environ["PATH"] = f"{BIN_DIR}{os.pathsep}{os.environ['PATH']}"
+
+    with tempfile.TemporaryDirectory(prefix="image-forge-bench-") as tmpdir:
+        tmpdir = Path(tmpdir)
+        tree = SyntheticTree(tmpdir, args.images, args.files, args.seed)
+        os.environ["BENCH_RPM_DB"] = tree.rpm_db.as_posix()
+        # build.py finds org/ and writes build/ in the current directory
+        os.chdir(tmpdir)
+        benchmarks = Benchmarks(tree)
+
+        results = {}
+        print(f"{'benchmark':<24} {'min, ms':>10} {'median, ms':>11}")
+        for name in args.benchmarks:
+            results[name] = benchmarks.run(name, args.repeat)
+            line = "{:<24} {:>10.1f} {:>11.1f}".format(
+                name, results[name]["min"] * 1e3, results[name]["median"] * 1e3
+            )
+            if baseline and name in baseline["results"]:
+                ratio = results[name]["min"] / baseline["results"][name]["min"]
+                line += f" {ratio:>6.2f}x"
+            print(line)
+
+    if output is not None:
+        output.write_text(
+            json.dumps(
+                {
+                    "revision": git_revision(),
+                    "python": platform.python_version(),
+                    "images": args.images,
+                    "files": args.files,
+                    "repeat": args.repeat,
+                    "seed": args.seed,
+                    "results": results,
+                },
+                indent=2,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
+
+# vim: colorcolumn=89
@@ -1,19 +1,39 @@
 #!/usr/bin/python3
 
 import argparse
+import concurrent.futures
+import contextlib
+import copy
+import datetime
 import functools
+import hashlib
 import json
 import re
 import subprocess
+import sys
+import tempfile
 import textwrap
+import threading
+import time
 from graphlib import TopologicalSorter
 from pathlib import Path
 
 import tomli
-from jinja2 import Template
+from jinja2 import Environment
 
 
 ORG_DIR = Path("org")
+BUILD_DIR = Path("build")
+JINJA_ENV = Environment()
+APT_CACHE_DIRS = {
+    "archives": "/var/cache/apt/archives",
+    "lists": "/var/lib/apt/lists",
+}
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_template(template: str):
+    return JINJA_ENV.from_string(template)
 
 
 class Image:
@@ -27,12 +47,65 @@ class Image:
                 f'path="{self.path}", base_name="{self.base_name}")')
 
 
+class CatalogImage:
+    def __init__(self, image_path: Path):
+        self.image = Image("/".join(image_path.parts[-2:]))
+        self.path = image_path
+        self.dockerfile_template = image_path / "Dockerfile.template"
+        self.distrolessfile = image_path / "distroless.toml"
+
+        names = {p.name for p in image_path.iterdir()}
+        if self.dockerfile_template.name in names:
+            self.template = self.dockerfile_template.read_text()
+            self.from_lines = [
+                line
+                for line in self.template.splitlines()
+                if re.match(r"\s*FROM", line)
+            ]
+        else:
+            self.template = None
+            self.from_lines = []
+        if self.distrolessfile.name in names:
+            self.distroless = tomli.loads(self.distrolessfile.read_text())
+        else:
+            self.distroless = None
+
+
+class ImageCatalog:
+    """Index of all images in ORG_DIR, every directory and file is read once."""
+
+    def __init__(self, org_dir=ORG_DIR):
+        self._images = {}
+        for organization_path in sorted(p for p in org_dir.iterdir() if p.is_dir()):
+            organization = self._images.setdefault(organization_path.name, {})
+            for image_path in sorted(organization_path.iterdir()):
+                catalog_image = CatalogImage(image_path)
+                organization[catalog_image.image.canonical_name] = catalog_image
+
+    @property
+    def organizations(self):
+        return list(self._images)
+
+    @property
+    def canonical_names(self):
+        return [i for o in self._images.values() for i in o]
+
+    def images(self, organization):
+        return self._images.get(organization, {}).values()
+
+    def get(self, canonical_name):
+        organization = canonical_name.split("/")[0]
+        return self._images.get(organization, {}).get(canonical_name)
+
+
 class Tasks:
     def __init__(self, tasks):
         if tasks is None:
+            self.tasks_file = None
             self._tasks = None
         else:
-            self._tasks = tomli.loads(Path(tasks).read_text())
+            self.tasks_file = Path(tasks)
+            self._tasks = tomli.loads(self.tasks_file.read_text())
 
     def __str__(self):
         return f"{self._tasks}"
@@ -69,45 +142,31 @@ class Tags:
 
 
 class Distroless:
-    def __init__(self, distrolessfile, renderer):
-        dd = tomli.loads(distrolessfile.read_text())
+    """Raw distroless spec with its renders per arch and branch."""
 
-        self.raw_from = dd["from"]
+    def __init__(self, distroless: dict, renderer):
+        self.spec = distroless
         self.renderer = renderer
-        self.from_ = renderer(dd["from"])
+        self.raw_from = distroless["from"]
+        self.from_ = renderer(self.raw_from)
+        self._rendered = {}
+        self._lock = threading.Lock()
 
-        self.file_lists = dd.get("file-lists", [])
-        self.files = dd.get("files", [])
-        self.library_files = dd.get("library-files", [])
-        self.packages = dd.get("packages", [])
-        self.library_packages = dd.get("library-packages", [])
-        self.exclude_regexes = dd.get("exclude-regexes", [])
-
-        self.builder_install_packages = dd.get("builder-install-packages", [])
+    def render_arch_branch(self, arch, branch):
+        with self._lock:
+            if (arch, branch) not in self._rendered:
+                rendered = RenderedDistroless(self, arch, branch)
+                self._rendered[(arch, branch)] = rendered
+            return self._rendered[(arch, branch)]
 
-        for file in dd.get("full-files", []):
-            self.builder_install_packages.append(file)
-            self.files.append(file)
-            self.library_files.append(file)
+    def render_arches(self, arches, branch):
+        return {arch: self.render_arch_branch(arch, branch) for arch in arches}
 
-        self.timezone = dd.get("timezone")
-        if self.timezone:
-            self.files.append("/etc/localtime")
 
-        self.copy = dd.get("copy", {})
+class RenderedDistroless:
+    """Distroless spec rendered for an arch and a branch, must not be modified."""
 
-        self.config_options = []
-        for option in ["cmd", "entrypoint", "user"]:
-            if value := dd.get(option):
-                if isinstance(value, list):
-                    value = json.dumps(value)
-                self.config_options.append(f"--{option}={value}")
-        if value := dd.get("workdir"):
-            self.config_options.append(f"--workingdir={value}")
-        elif value := dd.get("workingdir"):
-            self.config_options.append(f"--workingdir={value}")
-
-    def render_arch_branch(self, arch, branch):
+    def __init__(self, distroless: Distroless, arch, branch):
         def if_arches(arches, value, default=""):
             if arch in arches or not arches:
                 return value
@@ -127,7 +186,7 @@ class Distroless:
                 return value
 
         renderer = functools.partial(
-            self.renderer,
+            distroless.renderer,
             if_arches=if_arches,
             if_branches=if_branches,
             if_arches_branches=if_arches_branches,
@@ -139,14 +198,421 @@ class Distroless:
             else:
                 return [r for v in values if (r := renderer(v)) != ""]
 
-        self.builder_install_packages = filter_map(self.builder_install_packages)
-        self.config_options = filter_map(self.config_options)
-        self.copy = filter_map(self.copy)
-        self.file_lists = filter_map(self.file_lists)
-        self.files = filter_map(self.files)
-        self.library_files = filter_map(self.library_files)
-        self.library_packages = filter_map(self.library_packages)
-        self.packages = filter_map(self.packages)
+        spec = distroless.spec
+        full_files = spec.get("full-files", [])
+        self.timezone = spec.get("timezone")
+        localtime = ["/etc/localtime"] if self.timezone else []
+
+        config_options = []
+        for option in ["cmd", "entrypoint", "user"]:
+            if value := spec.get(option):
+                if isinstance(value, list):
+                    value = json.dumps(value)
+                config_options.append(f"--{option}={value}")
+        if value := spec.get("workdir"):
+            config_options.append(f"--workingdir={value}")
+        elif value := spec.get("workingdir"):
+            config_options.append(f"--workingdir={value}")
+
+        self.arch = arch
+        self.branch = branch
+        self.from_ = distroless.from_
+        self.builder_install_packages = filter_map(
+            spec.get("builder-install-packages", []) + full_files
+        )
+        self.config_options = filter_map(config_options)
+        self.copy = filter_map(spec.get("copy", {}))
+        self.exclude_regexes = list(spec.get("exclude-regexes", []))
+        self.file_lists = filter_map(spec.get("file-lists", []))
+        self.files = filter_map(spec.get("files", []) + full_files + localtime)
+        self.library_files = filter_map(spec.get("library-files", []) + full_files)
+        self.library_packages = filter_map(spec.get("library-packages", []))
+        self.packages = filter_map(spec.get("packages", []))
+        self.layers = [
+            {
+                "files": filter_map(layer.get("files", [])),
+                "file_lists": filter_map(layer.get("file-lists", [])),
+                "library_files": filter_map(layer.get("library-files", [])),
+                "library_packages": filter_map(layer.get("library-packages", [])),
+                "packages": filter_map(layer.get("packages", [])),
+            }
+            for layer in spec.get("layers", [])
+        ]
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+def sha256_files(root: Path):
+    sha256 = hashlib.sha256()
+    for file in sorted(p for p in root.rglob("*") if p.is_file()):
+        sha256.update(file.relative_to(root).as_posix().encode() + b"\0")
+        sha256.update(hashlib.sha256(file.read_bytes()).digest())
+    return sha256.hexdigest()
+
+
+def sha256_json(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+def load_json(json_file):
+    """Parsed JSON file, an empty dict if it does not exist."""
+    json_file = Path(json_file)
+    if json_file.exists():
+        return json.loads(json_file.read_text())
+    return {}
+
+
+def save_json(json_file, value):
+    """Write JSON file through a temporary file, so it is never left truncated."""
+    json_file = Path(json_file)
+    json_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = json_file.with_suffix(".tmp")
+    tmp_file.write_text(json.dumps(value, indent=2, sort_keys=True))
+    tmp_file.replace(json_file)
+
+
+class ManifestCache:
+    """Entries of manifests, saved after every change."""
+
+    def __init__(self, cache_file):
+        self.cache_file = Path(cache_file)
+        self._entries = load_json(self.cache_file)
+        self._lock = threading.Lock()
+
+    def get(self, manifest):
+        with self._lock:
+            return self._entries.get(manifest)
+
+    def set(self, manifest, entry):
+        with self._lock:
+            self._entries[manifest] = entry
+            save_json(self.cache_file, self._entries)
+
+
+class BuildCache(ManifestCache):
+    """Cache keys of built manifests with the digests they were built to."""
+
+    def __init__(self, cache_file):
+        super().__init__(cache_file)
+        self.hits = []
+        self.misses = []
+
+    def record(self, manifest, hit):
+        with self._lock:
+            (self.hits if hit else self.misses).append(manifest)
+
+    def store(self, manifest, key, digest):
+        self.set(manifest, {"key": key, "digest": digest})
+
+    def report(self):
+        print(f"Build cache: {len(self.hits)} hits, {len(self.misses)} misses")
+        for manifest in sorted(self.hits):
+            print(f"  hit  {manifest}")
+        for manifest in sorted(self.misses):
+            print(f"  miss {manifest}")
+
+
+class RequiresCache:
+    """Requires of images per builder, valid while their FROM sources match."""
+
+    def __init__(self, cache_file):
+        self.cache_file = Path(cache_file)
+        self._entries = load_json(self.cache_file)
+        self._changed = False
+
+    def get(self, builder_key, canonical_name, source_hash):
+        entry = self._entries.get(builder_key, {}).get(canonical_name)
+        if entry is not None and entry["hash"] == source_hash:
+            return set(entry["requires"])
+
+    def set(self, builder_key, canonical_name, source_hash, requires):
+        entries = self._entries.setdefault(builder_key, {})
+        entries[canonical_name] = {"hash": source_hash, "requires": sorted(requires)}
+        self._changed = True
+
+    def save(self):
+        if self._changed:
+            save_json(self.cache_file, self._entries)
+            self._changed = False
+
+
+class PushCache(ManifestCache):
+    """Registry digests of pushed manifests and results of pushes."""
+
+    def __init__(self, cache_file):
+        super().__init__(cache_file)
+        self.results = {"pushed": [], "updated": [], "skipped": [], "dry-run": []}
+
+    def record(self, manifest, result):
+        with self._lock:
+            self.results[result].append(manifest)
+
+    def store(self, manifest, local_digest, remote_digest):
+        self.set(manifest, {"local": local_digest, "remote": remote_digest})
+
+    def report(self):
+        counts = ", ".join(f"{len(m)} {r}" for r, m in self.results.items())
+        print(f"Push: {counts}")
+        for result, manifests in self.results.items():
+            for manifest in sorted(manifests):
+                print(f"  {result:7} {manifest}")
+
+
+class Tracer:
+    """Record spans of stages and commands as Chrome trace events.
+
+    Spans get the image, branch and arch of the current thread context in their
+    args, so the summary can sum them up per image and arch.
+    """
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._events = []
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def current_context(self):
+        return getattr(self._local, "context", {})
+
+    @contextlib.contextmanager
+    def context(self, **kwargs):
+        old_context = self.current_context()
+        self._local.context = old_context | kwargs
+        try:
+            yield
+        finally:
+            self._local.context = old_context
+
+    def annotate(self, **kwargs):
+        """Add kwargs to args of the innermost open span of the current thread."""
+        if spans := getattr(self._local, "spans", None):
+            spans[-1].update(kwargs)
+
+    @contextlib.contextmanager
+    def span(self, name, category, **kwargs):
+        if not hasattr(self._local, "spans"):
+            self._local.spans = []
+        self._local.spans.append(kwargs)
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            kwargs["error"] = True
+            raise
+        finally:
+            end = time.perf_counter()
+            self._local.spans.pop()
+            thread = threading.current_thread()
+            event = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": round((start - self._start) * 1e6),
+                "dur": round((end - start) * 1e6),
+                "pid": 1,
+                "tid": thread.ident,
+                "args": self.current_context() | kwargs,
+            }
+            with self._lock:
+                self._events.append(event)
+                self._threads[thread.ident] = thread.name
+
+    def events(self):
+        with self._lock:
+            return list(self._events)
+
+    def summary(self):
+        images = {}
+        commands = {}
+        for event in self.events():
+            args = event["args"]
+            seconds = event["dur"] / 1e6
+            if event["cat"] == "command":
+                commands[event["name"]] = commands.get(event["name"], 0) + seconds
+            if event["cat"] != "stage" or "image" not in args:
+                continue
+            entry = images.setdefault(
+                f"{args['image']}:{args['branch']}", {"stages": {}, "arches": {}}
+            )
+            if event["name"] == "build_arch":
+                times, key = entry["arches"], args["arch"]
+            else:
+                times, key = entry["stages"], event["name"]
+            times[key] = times.get(key, 0) + seconds
+        for entry in images.values():
+            for times in entry.values():
+                for key in times:
+                    times[key] = round(times[key], 3)
+        commands = {k: round(v, 3) for k, v in commands.items()}
+        return {"images": images, "commands": commands}
+
+    def save(self, trace_file):
+        trace_file = Path(trace_file)
+        with self._lock:
+            events = list(self._events)
+            threads = dict(self._threads)
+        for tid, thread_name in threads.items():
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": 1,
+                    "tid": tid,
+                    "args": {"name": thread_name},
+                }
+            )
+        trace_file.parent.mkdir(parents=True, exist_ok=True)
+        trace_file.write_text(json.dumps({"traceEvents": events}))
+        summary_file = trace_file.with_suffix(".summary.json")
+        summary_file.write_text(json.dumps(self.summary(), indent=2, sort_keys=True))
+
+
+class DurationHistory:
+    """Durations of the last builds of images and their arches."""
+
+    def __init__(self, history_file):
+        self.history_file = Path(history_file)
+        self._entries = load_json(self.history_file)
+
+    def update(self, tracer: Tracer):
+        """Take durations of builds from tracer, skipping cached and failed ones."""
+        builds = {}
+        for event in tracer.events():
+            args = event["args"]
+            if event["cat"] != "stage" or event["name"] not in ["build", "build_arch"]:
+                continue
+            key = f"{args['image']}:{args['branch']}"
+            build = builds.setdefault(key, {"arches": {}, "skip": False})
+            seconds = event["dur"] / 1e6
+            if args.get("cached") or args.get("error"):
+                build["skip"] = True
+            elif event["name"] == "build_arch":
+                build["arches"][args["arch"]] = seconds
+            else:
+                build["build"] = seconds
+        for key, build in builds.items():
+            entry = self._entries.setdefault(key, {"arches": {}})
+            entry["arches"].update(build["arches"])
+            if "build" in build and not build["skip"]:
+                entry["build"] = build["build"]
+
+    def estimate(self, key, arches, arch_jobs=1):
+        """Estimate build duration of image key for arches, None if unknown."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        arch_times = [entry["arches"].get(a) for a in arches]
+        if arch_times and None not in arch_times:
+            parallel = min(arch_jobs, len(arch_times))
+            return max(max(arch_times), sum(arch_times) / parallel)
+        return entry.get("build")
+
+    def save(self):
+        save_json(self.history_file, self._entries)
+
+
+class Checkpoint:
+    """Done stages of nodes of a plan, saved after every stage to resume the plan."""
+
+    def __init__(self, checkpoint_file, plan_hash, resume=False, readonly=False):
+        self.checkpoint_file = Path(checkpoint_file)
+        self.plan_hash = plan_hash
+        self.readonly = readonly
+        self._done = {}
+        self._lock = threading.Lock()
+        if resume and (checkpoint := load_json(self.checkpoint_file)):
+            if checkpoint["plan"] != plan_hash:
+                raise ValueError(
+                    f"{self.checkpoint_file} is a checkpoint of another plan"
+                )
+            self._done = {k: set(v) for k, v in checkpoint["done"].items()}
+
+    def __len__(self):
+        return sum(len(stages) for stages in self._done.values())
+
+    def done(self, node_id, stage):
+        with self._lock:
+            return stage in self._done.get(node_id, set())
+
+    def mark(self, node_id, stage):
+        if self.readonly:
+            return
+        with self._lock:
+            self._done.setdefault(node_id, set()).add(stage)
+            checkpoint = {
+                "plan": self.plan_hash,
+                "done": {k: sorted(v) for k, v in self._done.items()},
+            }
+            save_json(self.checkpoint_file, checkpoint)
+
+
+class ArchDigests:
+    """Registry digests of arch images pushed by shards, to assemble manifests.
+
+    A shard stores the digests it pushed to the first file, the assemble stage
+    reads the files of all shards.
+    """
+
+    def __init__(self, digests_files):
+        self.digests_files = [Path(f) for f in digests_files]
+        self.digests_file = self.digests_files[0]
+        self._digests = {}
+        for digests_file in self.digests_files:
+            for manifest, digests in load_json(digests_file).items():
+                self._digests.setdefault(manifest, {}).update(digests)
+        self._lock = threading.Lock()
+
+    def get(self, manifest, arch):
+        with self._lock:
+            return self._digests.get(manifest, {}).get(arch)
+
+    def store(self, manifest, arch, digest):
+        with self._lock:
+            self._digests.setdefault(manifest, {})[arch] = digest
+            save_json(self.digests_file, self._digests)
+
+
+class BuilderPool:
+    """Snapshots of distroless builders with task repos added and apt lists updated.
+
+    A snapshot image is committed once per branch, arch, tasks and builder
+    image, builders of distroless images are started from it, so every image
+    gets a clean builder and only installs its own packages.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._snapshots = {}
+
+    def snapshot(self, key, create):
+        """Name of the snapshot image of key, created with create(name) once."""
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                if key in self._snapshots:
+                    return self._snapshots[key]
+            branch, arch = key[:2]
+            name = f"distroless-builder-{branch}-{arch}-{sha256_json(key)[:12]}"
+            create(name)
+            with self._lock:
+                self._snapshots[key] = name
+            return name
+
+    def remove_all(self, run):
+        with self._lock:
+            names = list(self._snapshots.values())
+            self._snapshots = {}
+        if names:
+            run(
+                ["buildah", "rmi"] + names,
+                check=False,
+                stderr=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+            )
 
 
 class DockerBuilder:
@@ -172,11 +638,26 @@ class DockerBuilder:
         images_info,
         tasks: Tasks,
         tags: Tags,
+        arch_jobs=1,
+        build_cache: BuildCache = None,
+        catalog: ImageCatalog = None,
+        requires_cache: RequiresCache = None,
+        builder_pool: BuilderPool = None,
+        apt_cache=False,
+        apt_volumes=(),
+        push_retries=0,
+        push_cache: PushCache = None,
+        tls_verify=True,
+        tracer: Tracer = None,
+        sharded=False,
+        arch_digests: ArchDigests = None,
+        staging_organization=None,
     ):
         self.image_re = re.compile(self.make_image_re())
         self.dockerfile_from_re = re.compile(self.make_dockerfile_from_re())
         self.org_dir = ORG_DIR
         self.images_dir = ORG_DIR / organization
+        self.dockerfiles_dir = BUILD_DIR / branch
         self.registry = registry
         self.branch = branch
         self.organization = organization
@@ -189,21 +670,41 @@ class DockerBuilder:
         self.images_info = images_info
         self.tasks = tasks
         self.tags = tags
+        self.arch_jobs = arch_jobs
+        self.build_cache = build_cache
+        self.catalog = catalog or ImageCatalog()
+        self.requires_cache = requires_cache
+        self.builder_pool = builder_pool
+        self.apt_cache = apt_cache
+        self.apt_volumes = apt_volumes
+        self.push_retries = push_retries
+        self.push_cache = push_cache
+        self.tls_verify = tls_verify
+        self.tracer = tracer or Tracer()
+        self.sharded = sharded
+        self.arch_digests = arch_digests
+        self.staging_organization = staging_organization
         self.distrolesses = {}
 
     def forall_images(consume_result):
         def forall_images_decorator(f):
             def wrapped(self, *args, **kwargs):
-                for image_path in self.images_dir.iterdir():
-                    image = Image("/".join(image_path.parts[1:]))
+                for catalog_image in self.catalog.images(self.organization):
+                    image = catalog_image.image
                     local_kwargs = {
                         "image": image,
-                        "dockerfile": image_path / "Dockerfile",
-                        "dockerfile_template": image_path / "Dockerfile.template",
-                        "distrolessfile": image_path / "distroless.toml",
+                        "catalog_image": catalog_image,
+                        "dockerfile": self.dockerfile(image),
+                        "dockerfile_template": catalog_image.dockerfile_template,
+                        "distrolessfile": catalog_image.distrolessfile,
                     }
                     new_kwargs = kwargs | local_kwargs
-                    yield f(self, *args, **new_kwargs)
+                    with self.tracer.context(
+                        image=image.canonical_name, branch=self.branch
+                    ):
+                        with self.tracer.span(f.__name__, "stage"):
+                            result = f(self, *args, **new_kwargs)
+                    yield result
 
             def consumer(*args, **kwargs):
                 for _ in wrapped(*args, **kwargs):
@@ -216,6 +717,23 @@ class DockerBuilder:
 
         return forall_images_decorator
 
+    def traced(name):
+        def traced_decorator(f):
+            @functools.wraps(f)
+            def wrapped(self, image: Image, *args, **kwargs):
+                with self.tracer.context(
+                    image=image.canonical_name, branch=self.branch
+                ):
+                    with self.tracer.span(name, "stage"):
+                        return f(self, image, *args, **kwargs)
+
+            return wrapped
+
+        return traced_decorator
+
+    def dockerfile(self, image: Image):
+        return self.dockerfiles_dir / image.canonical_name / "Dockerfile"
+
     @forall_images(consume_result=True)
     def remove_dockerfiles(self, **kwargs):
         if kwargs["dockerfile"].exists():
@@ -234,7 +752,7 @@ class DockerBuilder:
         else:
             registry = ""
             alt_image = "alt"
-        rendered = Template(template).render(
+        rendered = compile_template(template).render(
             alt_image=alt_image,
             branch=self.branch,
             install_pakages=install_pakages,
@@ -257,24 +775,40 @@ class DockerBuilder:
                 apt_repo += "\n    apt-get update && \\"
             else:
                 apt_repo = "\\"
-            update_command = f"""RUN apt-get update && {apt_repo}"""
-            install_command = f"""
-            {linux32} apt-get install -y {' '.join(names)} && \\
-            rm -f /var/cache/apt/archives/*.rpm \\
-                  /var/cache/apt/*.bin \\
-                  /var/lib/apt/lists/*.*
-            """
+            if self.apt_cache:
+                # cache mounts are shared between builds and are not committed
+                mounts = ""
+                for cache, target in APT_CACHE_DIRS.items():
+                    mounts += (
+                        f"--mount=type=cache,id=apt-{cache}-{self.branch},"
+                        f"target={target},sharing=locked \\\n    "
+                    )
+                partial_dirs = " ".join(f"{d}/partial" for d in APT_CACHE_DIRS.values())
+                mounts += f"mkdir -p {partial_dirs} && \\\n    "
+                update_command = f"""RUN {mounts}apt-get update && {apt_repo}"""
+                install_command = f"""
+                {linux32} apt-get install -y {' '.join(names)} && \\
+                rm -f /var/cache/apt/*.bin
+                """
+            else:
+                update_command = f"""RUN apt-get update && {apt_repo}"""
+                install_command = f"""
+                {linux32} apt-get install -y {' '.join(names)} && \\
+                rm -f /var/cache/apt/archives/*.rpm \\
+                      /var/cache/apt/*.bin \\
+                      /var/lib/apt/lists/*.*
+                """
             install_command = textwrap.dedent(install_command).rstrip("\n")
             install_command = textwrap.indent(install_command, " " * 4)
             return update_command + install_command
 
-        dockerfile_template = kwargs["dockerfile_template"]
-        if dockerfile_template.exists():
+        if (template := kwargs["catalog_image"].template) is not None:
             rendered = self.render_template(
-                dockerfile_template.read_text(),
+                template,
                 self.overwrite_organization,
                 install_pakages,
             )
+            kwargs["dockerfile"].parent.mkdir(parents=True, exist_ok=True)
             kwargs["dockerfile"].write_text(rendered + "\n")
 
     @forall_images(consume_result=True)
@@ -283,22 +817,38 @@ class DockerBuilder:
             self.render_template,
             organization=self.overwrite_organization,
         )
-        distrolessfile = kwargs["distrolessfile"]
-        canonical_name = "/".join(distrolessfile.parts[-3:-1])
-        if distrolessfile.exists():
-            self.distrolesses[canonical_name] = Distroless(distrolessfile, renderer)
+        catalog_image = kwargs["catalog_image"]
+        canonical_name = catalog_image.image.canonical_name
+        if catalog_image.distroless is not None:
+            self.distrolesses[canonical_name] = Distroless(
+                catalog_image.distroless, renderer
+            )
 
     @forall_images(consume_result=False)
     def get_requires(self, **kwargs):
-        requires = set()
-        dockerfile_template = kwargs["dockerfile_template"]
-        distrolessfile = kwargs["distrolessfile"]
+        catalog_image = kwargs["catalog_image"]
         canonical_name = kwargs["image"].canonical_name
+        if self.requires_cache is None:
+            return (canonical_name, self.parse_requires(catalog_image))
+
+        builder_key = f"{self.organization}:{self.branch}:{self.registry}"
+        source_hash = sha256_json(
+            [
+                catalog_image.from_lines,
+                (catalog_image.distroless or {}).get("from"),
+            ]
+        )
+        requires = self.requires_cache.get(builder_key, canonical_name, source_hash)
+        if requires is None:
+            requires = self.parse_requires(catalog_image)
+            self.requires_cache.set(builder_key, canonical_name, source_hash, requires)
+        return (canonical_name, requires)
+
+    def parse_requires(self, catalog_image: CatalogImage):
+        requires = set()
 
-        if dockerfile_template.exists():
-            for line in dockerfile_template.read_text().splitlines():
-                if not re.match(r"\s*FROM", line):
-                    continue
+        if catalog_image.template is not None:
+            for line in catalog_image.from_lines:
                 line = self.render_template(line, self.organization)
                 if match := re.match(self.dockerfile_from_re, line):
                     from_image = match.groupdict()
@@ -306,32 +856,36 @@ class DockerBuilder:
                         requires.add(
                             f"{from_image['organization']}/{from_image['name']}"
                         )
-        elif distrolessfile.exists():
+        elif catalog_image.distroless is not None:
             requires.add("alt/distroless-builder")
-            raw_from = self.distrolesses[canonical_name].raw_from
+            raw_from = catalog_image.distroless["from"]
             from_ = self.render_template(raw_from, self.organization)
             if match := re.match(self.image_re, from_):
                 from_image = match.groupdict()
                 if from_image["name"] != "scratch":
                     requires.add(f"{from_image['organization']}/{from_image['name']}")
 
-        return (canonical_name, requires)
+        return requires
 
-    def get_build_order(self):
+    def get_requires_graph(self):
         requires = {}
         for canonical_name, image_requires in self.get_requires():
             requires[canonical_name] = image_requires
-        ts = TopologicalSorter(requires)
+        return requires
+
+    def get_build_order(self):
+        ts = TopologicalSorter(self.get_requires_graph())
         return (Image(i) for i in ts.static_order())
 
-    def render_full_tag(self, image: Image, tag: str):
+    def render_full_tag(self, image: Image, tag: str, organization=None):
         if self.registry:
             registry = self.registry.rstrip("/") + "/"
         else:
             registry = ""
         if tag:
             tag = f":{tag}"
-        return f"{registry}{self.overwrite_organization}/{image.base_name}{tag}"
+        organization = organization or self.overwrite_organization
+        return f"{registry}{organization}/{image.base_name}{tag}"
 
     def run(self, cmd, *args, **kwargs):
         if "check" not in kwargs:
@@ -340,51 +894,248 @@ class DockerBuilder:
             pre_cmd = ["echo"]
         else:
             pre_cmd = []
-        subprocess.run(pre_cmd + cmd, *args, **kwargs)
+        with self.tracer.span(" ".join(cmd[:2]), "command", cmd=cmd):
+            subprocess.run(pre_cmd + cmd, *args, **kwargs)
+
+    def run_retry(self, cmd, retries):
+        for attempt in range(retries + 1):
+            try:
+                return self.run(cmd)
+            except subprocess.CalledProcessError:
+                if attempt == retries:
+                    raise
+                delay = 2**attempt
+                print(f"Command {' '.join(cmd)} failed, retry in {delay}s")
+                time.sleep(delay)
+
+    def run_output(self, cmd, check=True, strip=True):
+        """Run read-only query cmd even in dry run, return None on failure."""
+        try:
+            with self.tracer.span(" ".join(cmd[:2]), "query", cmd=cmd):
+                proc = subprocess.run(
+                    cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+                )
+        except FileNotFoundError:
+            return None
+        if check and proc.returncode != 0:
+            return None
+        return proc.stdout.strip() if strip else proc.stdout
+
+    def image_digest(self, ref):
+        if manifest := self.run_output(["podman", "manifest", "inspect", ref]):
+            return "sha256:" + hashlib.sha256(manifest.encode()).hexdigest()
+        inspect_cmd = ["podman", "image", "inspect", "--format", "{{.Digest}}", ref]
+        return self.run_output(inspect_cmd) or None
+
+    def registry_digest(self, ref):
+        inspect_cmd = ["skopeo", "inspect", "--raw", f"docker://{ref}"]
+        if not self.tls_verify:
+            inspect_cmd.insert(2, "--tls-verify=false")
+        if manifest := self.run_output(inspect_cmd, strip=False):
+            return "sha256:" + hashlib.sha256(manifest.encode()).hexdigest()
+
+    def push_record(self, manifest, result):
+        if result == "skipped":
+            print(f"Manifest {manifest} is up to date in registry, skip pushing")
+        elif self.dry_run:
+            result = "dry-run"
+        if self.push_cache is not None:
+            self.push_cache.record(manifest, result)
+
+    def image_id(self, ref):
+        inspect_cmd = ["podman", "image", "inspect", "--format", "{{.Id}}", ref]
+        return self.run_output(inspect_cmd) or None
+
+    def build_cache_hit(self, manifest, cache_key, get_digest=None):
+        if self.build_cache is None:
+            return False
+        get_digest = get_digest or self.image_digest
+        entry = self.build_cache.get(manifest)
+        hit = (
+            cache_key is not None
+            and entry is not None
+            and entry["key"] == cache_key
+            and entry["digest"] == get_digest(manifest)
+        )
+        self.build_cache.record(manifest, hit)
+        if hit:
+            self.tracer.annotate(cached=True)
+        return hit
+
+    def build_cache_store(self, manifest, cache_key, get_digest=None):
+        if self.build_cache is None or cache_key is None or self.dry_run:
+            return
+        get_digest = get_digest or self.image_digest
+        if digest := get_digest(manifest):
+            self.build_cache.store(manifest, cache_key, digest)
+
+    def distroless_cache_key(
+        self, image: Image, distroless: RenderedDistroless, builder, builder_image
+    ):
+        digests = {}
+        for ref in [builder_image, distroless.from_]:
+            if ref != "scratch":
+                if (digest := self.image_digest(ref)) is None:
+                    return None
+                digests[ref] = digest
+
+        # packages installed in the builder after apt-get reinstall, files of
+        # the image are taken from them
+        query_format = r"--queryformat=%{NAME}-%{EPOCH}:%{VERSION}-%{RELEASE}\n"
+        rpm_cmd = ["buildah", "run", builder, "rpm", "-qa", query_format]
+        if (output := self.run_output(rpm_cmd)) is None:
+            return None
+        versions = output.splitlines()
+
+        spec = distroless.as_dict()
+        return sha256_json(
+            {
+                "digests": digests,
+                "files": sha256_files(image.path),
+                "spec": spec,
+                "tasks": self.tasks.get(self.branch, image),
+                "versions": sorted(versions),
+            }
+        )
+
+    def podman_build_cache_key(self, image: Image, build_arches, tags):
+        dockerfile = self.dockerfile(image).read_text()
+        parents = {}
+        stages = {"scratch"}
+        for line in dockerfile.splitlines():
+            if match := re.match(r"\s*FROM\s+(\S+)(\s+as\s+(\S+))?", line, re.I):
+                if match.group(1) not in stages:
+                    digest = self.image_digest(match.group(1))
+                    if digest is None:
+                        return None
+                    parents[match.group(1)] = digest
+                if match.group(3):
+                    stages.add(match.group(3))
+        return sha256_json(
+            {
+                "arches": sorted(build_arches),
+                "context": sha256_files(image.path),
+                "dockerfile": dockerfile,
+                "parents": parents,
+                "tags": tags,
+                "tasks": self.tasks.get(self.branch, image),
+            }
+        )
+
+    def per_arch_images(self, distroless=False):
+        # distroless arches are cached separately, podman caches Dockerfile
+        # images per manifest, so they are built at once unless arches are
+        # built in parallel or by shards
+        if distroless and self.build_cache is not None:
+            return True
+        return self.arch_jobs > 1 or self.sharded
+
+    def arch_image(self, manifest, arch):
+        return f"{manifest}-{arch}"
+
+    def for_arches(self, func, arches):
+        context = self.tracer.current_context()
+
+        def traced_func(arch):
+            with self.tracer.context(**context, arch=arch):
+                with self.tracer.span("build_arch", "stage"):
+                    return func(arch)
+
+        with concurrent.futures.ThreadPoolExecutor(self.arch_jobs) as executor:
+            for _ in executor.map(traced_func, arches):
+                pass
+
+    def podman_manifest_create(self, manifest, arch_images):
+        self.run(["podman", "manifest", "create", manifest])
+        for arch_image in arch_images:
+            add_cmd = [
+                "podman",
+                "manifest",
+                "add",
+                manifest,
+                f"containers-storage:{arch_image}",
+            ]
+            self.run(add_cmd)
 
+    @traced("build")
     def distroless_build(self, image: Image, arches):
         def distroless_build_arch(arch, manifest):
             distroless_builder = self.render_full_tag(
                 Image("alt/distroless-builder"), self.branch
             )
-            distroless = self.distrolesses[image.canonical_name]
-            distroless.render_arch_branch(arch, self.branch)
-            builder = f"distroless-builder-{arch}"
-            new = f"distroless-new-{arch}"
+            distroless = rendered[arch]
+            name = image.canonical_name.replace("/", "-")
+            tasks = self.tasks.get(self.branch, image) or []
+            builder = f"distroless-builder-{self.branch}-{name}-{arch}"
+            new = f"distroless-new-{self.branch}-{name}-{arch}"
+            arch_image = self.arch_image(manifest, arch)
             run = functools.partial(self.run, cwd=image.path)
-            run(
-                ["buildah", "rm", builder, new],
-                check=False,
-                stderr=subprocess.DEVNULL,
-                stdout=subprocess.DEVNULL,
-            )
-            run(
-                [
-                    "buildah",
-                    "from",
-                    "--arch",
-                    arch,
-                    "--name",
-                    builder,
-                    distroless_builder,
-                ]
-            )
-            run(["buildah", "from", "--arch", arch, "--name", new, distroless.from_])
 
-            if packages := distroless.builder_install_packages:
-                tasks = self.tasks.get(self.branch, image)
+            def release_builder():
+                run(
+                    ["buildah", "rm", builder],
+                    check=False,
+                    stderr=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                )
+
+            def update_builder(container):
                 if tasks:
                     if arch == "386":
                         apt_repo_add = ["linux32", "apt-repo", "add"]
                     else:
                         apt_repo_add = ["apt-repo", "add"]
                     for task in tasks:
-                        run(["buildah", "run", builder] + apt_repo_add + [task])
-                run(["buildah", "run", builder, "apt-get", "update"])
+                        run(["buildah", "run", container] + apt_repo_add + [task])
+                run(["buildah", "run", container, "apt-get", "update"])
+
+            def create_snapshot(snapshot):
+                container = f"{snapshot}-update"
+                run(
+                    ["buildah", "rm", container],
+                    check=False,
+                    stderr=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                )
+                from_cmd = ["buildah", "from", "--arch", arch, "--name", container]
+                run(from_cmd + [distroless_builder])
+                update_builder(container)
+                run(["buildah", "commit", "--rm", container, snapshot])
+
+            packages = distroless.builder_install_packages
+            builder_image = distroless_builder
+            if packages and self.builder_pool is not None:
+                pool_key = (self.branch, arch, tuple(tasks), distroless_builder)
+                snapshot = self.builder_pool.snapshot(pool_key, create_snapshot)
+                builder_image = f"containers-storage:{snapshot}"
+
+            run(
+                ["buildah", "rm", builder, new],
+                check=False,
+                stderr=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+            )
+            run(["buildah", "from", "--arch", arch, "--name", builder, builder_image])
+
+            if packages:
+                if builder_image == distroless_builder:
+                    update_builder(builder)
                 run(
                     ["buildah", "run", builder, "apt-get", "reinstall", "-y"] + packages
                 )
 
+            cache_key = None
+            if self.build_cache is not None:
+                cache_key = self.distroless_cache_key(
+                    image, distroless, builder, distroless_builder
+                )
+                if self.build_cache_hit(arch_image, cache_key, self.image_id):
+                    print(f"Image {arch_image} is up to date, skip building")
+                    release_builder()
+                    return
+
+            run(["buildah", "from", "--arch", arch, "--name", new, distroless.from_])
+
             if timezone := distroless.timezone:
                 run(
                     [
@@ -392,72 +1143,100 @@ class DockerBuilder:
                         "run",
                         builder,
                         "ln",
-                        "-s",
+                        "-sf",
                         f"/usr/share/zoneinfo/{timezone}",
                         "/etc/localtime",
                     ]
                 )
 
-            options = []
-            if distroless.files:
-                options += ["-f"] + distroless.files
-            if distroless.library_files:
-                options += ["--library-files"] + distroless.library_files
-            if file_lists := distroless.file_lists:
-                options += ["-l"]
-                options += [f"file-lists/{f}" for f in file_lists]
-                for file_list in file_lists:
+            def files_options(
+                files, file_lists, library_files, library_packages, packages
+            ):
+                options = []
+                if files:
+                    options += ["-f"] + files
+                if library_files:
+                    options += ["--library-files"] + library_files
+                if file_lists:
+                    options += ["-l"]
+                    options += [f"file-lists/{f}" for f in file_lists]
+                if packages:
+                    options += ["-p"] + packages
+                if library_packages:
+                    options += ["--library-packages"] + library_packages
+                return options
+
+            # groups of layers first, the files of the image in the last layer
+            layers = distroless.layers + [
+                {
+                    "files": distroless.files,
+                    "file_lists": distroless.file_lists,
+                    "library_files": distroless.library_files,
+                    "library_packages": distroless.library_packages,
+                    "packages": distroless.packages,
+                }
+            ]
+            file_lists = {f for layer in layers for f in layer["file_lists"]}
+            for file_list in sorted(file_lists):
+                run(
+                    [
+                        "buildah",
+                        "copy",
+                        builder,
+                        f"./{file_list}",
+                        f"file-lists/{file_list}",
+                    ]
+                )
+
+            layer_images = []
+            for i, layer in enumerate(layers):
+                options = files_options(**layer)
+                if distroless.exclude_regexes:
+                    options += ["-r"] + distroless.exclude_regexes
+                if i > 0:
+                    # files of lower layers are not added again
+                    skip_lists = [f"layers/{j}.list" for j in range(i)]
+                    options += ["--skip-lists"] + skip_lists
+                if i < len(layers) - 1:
+                    options += ["--written-list", f"layers/{i}.list"]
+
+                # files are collected without the dl-file in a single Python run,
+                # the archive is still written once to a host file for buildah add
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    distroless_tar = Path(tmp_dir) / "distroless.tar"
+                    with open(distroless_tar, "wb") as stdout:
+                        run(
+                            [
+                                "buildah",
+                                "run",
+                                builder,
+                                "./distroless-builder.py",
+                                "build",
+                                "--reproducible",
+                            ]
+                            + options,
+                            stdout=None if self.dry_run else stdout,
+                        )
+                    run(["buildah", "add", new, distroless_tar.as_posix(), "/"])
+
+                if i < len(layers) - 1:
+                    # a layer per group with fixed timestamps, it is the same in
+                    # images with the same from image and the same lower groups
+                    layer_image = f"{new}-layer-{i}"
+                    layer_images.append(layer_image)
+                    commit_cmd = ["buildah", "commit", "--rm", "--timestamp=0"]
+                    run(commit_cmd + [new, layer_image])
                     run(
                         [
                             "buildah",
-                            "copy",
-                            builder,
-                            f"./{file_list}",
-                            f"file-lists/{file_list}",
+                            "from",
+                            "--arch",
+                            arch,
+                            "--name",
+                            new,
+                            f"containers-storage:{layer_image}",
                         ]
                     )
-            if distroless.packages:
-                options += ["-p"] + distroless.packages
-            if distroless.library_packages:
-                options += ["--library-packages"] + distroless.library_packages
-
-            run(
-                [
-                    "buildah",
-                    "run",
-                    builder,
-                    "./distroless-builder.py",
-                    "add",
-                    "--clean",
-                ]
-                + options
-            )
-
-            exclude_regexes_options = []
-            if distroless.exclude_regexes:
-                exclude_regexes_options = ["-r"] + distroless.exclude_regexes
-            run(
-                [
-                    "buildah",
-                    "run",
-                    builder,
-                    "./distroless-builder.py",
-                    "tar",
-                ]
-                + exclude_regexes_options
-            )
-
-            run(
-                [
-                    "buildah",
-                    "add",
-                    "--from",
-                    builder,
-                    new,
-                    "/usr/src/distroless/distroless.tar",
-                    "/",
-                ]
-            )
 
             for local_file, image_file in distroless.copy.items():
                 run(
@@ -472,13 +1251,14 @@ class DockerBuilder:
 
             run(["buildah", "config"] + distroless.config_options + [new])
 
-            run(["buildah", "commit", "--rm", "--manifest", manifest, new])
-            run(
-                ["buildah", "rm", builder],
-                check=False,
-                stderr=subprocess.DEVNULL,
-                stdout=subprocess.DEVNULL,
-            )
+            if self.per_arch_images(distroless=True):
+                run(["buildah", "commit", "--rm", new, arch_image])
+                self.build_cache_store(arch_image, cache_key, self.image_id)
+            else:
+                run(["buildah", "commit", "--rm", "--manifest", manifest, new])
+            if layer_images:
+                run(["buildah", "rmi"] + layer_images)
+            release_builder()
 
         if self.images_info.skip_branch(image.canonical_name, self.branch):
             return
@@ -488,6 +1268,10 @@ class DockerBuilder:
         )
         tags = self.tags.tags(self.branch, image)
         manifest = self.render_full_tag(image, tags[0])
+        # rendered once for all arches, arch builds share them read-only
+        rendered = self.distrolesses[image.canonical_name].render_arches(
+            build_arches, self.branch
+        )
 
         msg = "Building image {} for {} arches".format(
             manifest,
@@ -521,14 +1305,20 @@ class DockerBuilder:
             stdout=subprocess.DEVNULL,
         )
 
-        for arch in build_arches:
-            distroless_build_arch(arch, manifest)
+        self.for_arches(
+            lambda arch: distroless_build_arch(arch, manifest), build_arches
+        )
+        if self.per_arch_images(distroless=True):
+            self.podman_manifest_create(
+                manifest, [self.arch_image(manifest, a) for a in sorted(build_arches)]
+            )
 
         for tag in tags[1:]:
             other_manifest = self.render_full_tag(image, tag)
             tag_cmd = ["podman", "tag", manifest, other_manifest]
             self.run(tag_cmd)
 
+    @traced("build")
     def podman_build(self, image: Image, arches):
         if self.images_info.skip_branch(image.canonical_name, self.branch):
             return
@@ -537,9 +1327,17 @@ class DockerBuilder:
             self.images_info.skip_arches(image.canonical_name)
         )
         platforms = ",".join([f"linux/{a}" for a in build_arches])
+        dockerfile = self.dockerfile(image).absolute()
         tags = self.tags.tags(self.branch, image)
         manifest = self.render_full_tag(image, tags[0])
 
+        cache_key = None
+        if self.build_cache is not None:
+            cache_key = self.podman_build_cache_key(image, build_arches, tags)
+            if self.build_cache_hit(manifest, cache_key):
+                print(f"Image {manifest} is up to date, skip building")
+                return
+
         msg = "Building image {} for {} arches".format(
             manifest,
             arches,
@@ -571,43 +1369,453 @@ class DockerBuilder:
             stderr=subprocess.DEVNULL,
             stdout=subprocess.DEVNULL,
         )
-        build_cmd = [
-            "podman",
-            "build",
-            "--rm",
-            "--force-rm",
-            f"--manifest={manifest}",
-            f"--platform={platforms}",
-            ".",
-        ]
-        self.run(build_cmd, cwd=image.path)
+        if self.per_arch_images():
+
+            def podman_build_arch(arch):
+                build_cmd = [
+                    "podman",
+                    "build",
+                    "--rm",
+                    "--force-rm",
+                    f"--tag={self.arch_image(manifest, arch)}",
+                    f"--platform=linux/{arch}",
+                    f"--file={dockerfile}",
+                ]
+                build_cmd += [f"--volume={v}" for v in self.apt_volumes]
+                build_cmd += ["."]
+                self.run(build_cmd, cwd=image.path)
+
+            self.for_arches(podman_build_arch, build_arches)
+            self.podman_manifest_create(
+                manifest, [self.arch_image(manifest, a) for a in sorted(build_arches)]
+            )
+        else:
+            build_cmd = [
+                "podman",
+                "build",
+                "--rm",
+                "--force-rm",
+                f"--manifest={manifest}",
+                f"--platform={platforms}",
+                f"--file={dockerfile}",
+            ]
+            build_cmd += [f"--volume={v}" for v in self.apt_volumes]
+            build_cmd += ["."]
+            self.run(build_cmd, cwd=image.path)
+
+        self.build_cache_store(manifest, cache_key)
 
         for tag in tags[1:]:
             other_manifest = self.render_full_tag(image, tag)
             tag_cmd = ["podman", "tag", manifest, other_manifest]
             self.run(tag_cmd)
 
+    @traced("push")
     def podman_push(self, image: Image, sign=None):
         if self.images_info.skip_branch(image.canonical_name, self.branch):
             return
 
         tags = self.tags.tags(self.branch, image)
-        manifests = [self.render_full_tag(image, t) for t in tags]
-
-        for manifest in manifests:
+        manifest, *other_manifests = [self.render_full_tag(image, t) for t in tags]
+
+        # the local digest hashes podman manifest inspect output and podman may
+        # convert the manifest on push, so it never equals the registry digest:
+        # a tag is skipped only if the registry still has the digest pushed from
+        # the same local digest last time, as recorded in the push cache
+        local_digest = self.image_digest(manifest)
+        remote_digest = self.registry_digest(manifest)
+        if self.push_cache is not None:
+            entry = self.push_cache.get(manifest)
+        else:
+            entry = None
+        up_to_date = entry == {"local": local_digest, "remote": remote_digest}
+        if local_digest is not None and remote_digest is not None and up_to_date:
+            self.push_record(manifest, "skipped")
+        else:
             print(f"Push manifest {manifest}")
+            with tempfile.TemporaryDirectory() as tmpdir:
+                digestfile = Path(tmpdir) / "digest"
+                cmd = [
+                    "podman",
+                    "manifest",
+                    "push",
+                    f"--digestfile={digestfile}",
+                    manifest,
+                    f"docker://{manifest}",
+                ]
+                if not self.tls_verify:
+                    cmd.insert(3, "--tls-verify=false")
+                if sign is not None:
+                    cmd.append(f"--sign-by={sign}")
+                with self.tracer.span("push_tag", "stage", tag=manifest):
+                    self.run_retry(cmd, self.push_retries)
+                self.push_record(manifest, "updated" if remote_digest else "pushed")
+                if digestfile.exists():
+                    remote_digest = digestfile.read_text().strip()
+                else:
+                    remote_digest = None
+            if self.push_cache is not None and local_digest and remote_digest:
+                self.push_cache.store(manifest, local_digest, remote_digest)
+
+        # blobs are already in the registry, only manifests are copied
+        for other_manifest in other_manifests:
+            other_digest = self.registry_digest(other_manifest)
+            if remote_digest is not None and other_digest == remote_digest:
+                self.push_record(other_manifest, "skipped")
+                continue
+            print(f"Copy manifest {manifest} to {other_manifest}")
             cmd = [
-                "podman",
-                "manifest",
-                "push",
-                manifest,
+                "skopeo",
+                "copy",
+                "--all",
                 f"docker://{manifest}",
+                f"docker://{other_manifest}",
             ]
-
+            if not self.tls_verify:
+                cmd[3:3] = ["--src-tls-verify=false", "--dest-tls-verify=false"]
             if sign is not None:
                 cmd.append(f"--sign-by={sign}")
+            with self.tracer.span("push_tag", "stage", tag=other_manifest):
+                self.run_retry(cmd, self.push_retries)
+            self.push_record(other_manifest, "updated" if other_digest else "pushed")
 
-            self.run(cmd)
+    @traced("push")
+    def podman_push_arches(self, image: Image, arches, sign=None):
+        """Push images of arches built by a shard, to be assembled later."""
+        if self.images_info.skip_branch(image.canonical_name, self.branch):
+            return
+
+        tags = self.tags.tags(self.branch, image)
+        manifest = self.render_full_tag(image, tags[0])
+        for arch in sorted(arches):
+            arch_image = self.arch_image(manifest, arch)
+            # arch images are not pushed to the repository of the image, the
+            # assemble stage copies them there with the manifest
+            staging_image = self.render_full_tag(
+                image, f"{tags[0]}-{arch}", self.staging_organization
+            )
+            print(f"Push image {arch_image} to {staging_image}")
+            with tempfile.TemporaryDirectory() as tmpdir:
+                digestfile = Path(tmpdir) / "digest"
+                cmd = [
+                    "podman",
+                    "push",
+                    f"--digestfile={digestfile}",
+                    arch_image,
+                    f"docker://{staging_image}",
+                ]
+                if not self.tls_verify:
+                    cmd.insert(2, "--tls-verify=false")
+                if sign is not None:
+                    cmd.append(f"--sign-by={sign}")
+                with self.tracer.span("push_tag", "stage", tag=staging_image):
+                    self.run_retry(cmd, self.push_retries)
+                self.push_record(staging_image, "pushed")
+                # the tag may be overwritten before the assemble stage, the
+                # manifest is assembled from the pushed digest
+                if digestfile.exists() and self.arch_digests is not None:
+                    digest = digestfile.read_text().strip()
+                    self.arch_digests.store(manifest, arch, digest)
+
+    @traced("assemble")
+    def assemble(self, image: Image, arches, sign=None):
+        """Create manifest of arch images pushed by shards and push it."""
+        if self.images_info.skip_branch(image.canonical_name, self.branch):
+            return
+
+        tags = self.tags.tags(self.branch, image)
+        manifest = self.render_full_tag(image, tags[0])
+        print(f"Assemble manifest {manifest} of {', '.join(sorted(arches))} arches")
+        rm_manifest_cmd = ["podman", "manifest", "rm", manifest]
+        self.run(
+            rm_manifest_cmd,
+            check=False,
+            stderr=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+        )
+        repository = self.render_full_tag(image, "", self.staging_organization)
+        arch_refs = {}
+        for arch in sorted(arches):
+            if digest := self.arch_digests.get(manifest, arch):
+                arch_refs[arch] = f"{repository}@{digest}"
+            elif self.dry_run:
+                arch_refs[arch] = f"{repository}@<digest of {arch}>"
+            else:
+                raise ValueError(
+                    f"No pushed digest of {repository} {arch} image "
+                    f"in {', '.join(map(str, self.arch_digests.digests_files))}"
+                )
+
+        # pushing the manifest copies the arch images from the staging organization
+        self.run(["podman", "manifest", "create", manifest])
+        for arch, arch_ref in arch_refs.items():
+            add_cmd = ["podman", "manifest", "add", manifest, f"docker://{arch_ref}"]
+            if not self.tls_verify:
+                add_cmd.insert(3, "--tls-verify=false")
+            self.run_retry(add_cmd, self.push_retries)
+        self.podman_push(image, sign)
+
+
+def plan_id(canonical_name, branch):
+    return f"{canonical_name}:{branch}"
+
+
+def build_plan(graph, builders, images, stages, arches, images_info):
+    """Resolve graph of (branch, image) nodes to a plan of nodes in build order.
+
+    Every node has its requires, arches, tags and the stages to run for it,
+    distroless nodes also have their specs rendered for every arch. Nodes of
+    images which are not selected have no stages and are only kept as requires.
+    """
+    # sorted so the order of nodes does not depend on the order of sets
+    graph = {node: sorted(graph[node]) for node in sorted(graph)}
+    nodes = []
+    for node in TopologicalSorter(graph).static_order():
+        branch, canonical_name = node
+        organization = canonical_name.split("/")[0]
+        db = builders[(organization, branch)]
+        image = Image(canonical_name)
+        selected = canonical_name in images and not images_info.skip_branch(
+            canonical_name, branch
+        )
+        if selected:
+            tags = [db.render_full_tag(image, t) for t in db.tags.tags(branch, image)]
+            node_stages = [s for s in ["build", "push", "assemble"] if s in stages]
+        else:
+            tags = []
+            node_stages = []
+        node_arches = sorted(set(arches) - set(images_info.skip_arches(canonical_name)))
+        nodes.append(
+            {
+                "id": plan_id(canonical_name, branch),
+                "image": canonical_name,
+                "organization": organization,
+                "branch": branch,
+                "kind": "distroless" if canonical_name in db.distrolesses else "podman",
+                "arches": node_arches,
+                "tags": tags,
+                "stages": node_stages,
+                "requires": sorted(plan_id(r, b) for b, r in graph[node]),
+            }
+        )
+        if selected and canonical_name in db.distrolesses:
+            distroless = db.distrolesses[canonical_name]
+            nodes[-1]["distroless"] = {
+                arch: rendered.as_dict()
+                for arch, rendered in distroless.render_arches(
+                    node_arches, branch
+                ).items()
+            }
+    return {"nodes": nodes}
+
+
+def plan_hash(plan):
+    """Hash of plan which does not depend on the order of nodes and their lists."""
+    nodes = []
+    for node in sorted(plan["nodes"], key=lambda n: n["id"]):
+        node = dict(node)
+        for key in ["arches", "tags", "requires"]:
+            node[key] = sorted(node[key])
+        nodes.append(node)
+    return sha256_json({"nodes": nodes})
+
+
+def write_plan(plan_file, plan, tracer: Tracer = None):
+    """Write plan, with commands run for every node if tracer is given."""
+    plan = copy.deepcopy(plan)
+    if tracer is not None:
+        commands = {}
+        for event in sorted(tracer.events(), key=lambda e: e["ts"]):
+            args = event["args"]
+            if event["cat"] == "command" and "image" in args:
+                node_id = plan_id(args["image"], args["branch"])
+                commands.setdefault(node_id, []).append(args["cmd"])
+        for node in plan["nodes"]:
+            node["commands"] = commands.get(node["id"], [])
+    plan_file = Path(plan_file)
+    plan_file.parent.mkdir(parents=True, exist_ok=True)
+    plan_file.write_text(json.dumps(plan, indent=2))
+
+
+def graph_dependents(graph):
+    dependents = {node: [] for node in graph}
+    for node, requires in graph.items():
+        for require in requires:
+            dependents.setdefault(require, []).append(node)
+    return dependents
+
+
+def with_dependents(graph, nodes):
+    """Return nodes with all nodes of graph which require them."""
+    dependents = graph_dependents(graph)
+    result = set(nodes)
+    queue = list(nodes)
+    while queue:
+        for dependent in dependents.get(queue.pop(), []):
+            if dependent not in result:
+                result.add(dependent)
+                queue.append(dependent)
+    return result
+
+
+def is_git_commit(rev):
+    """Whether rev names a commit of the git repository in the current directory."""
+    try:
+        proc = subprocess.run(
+            ["git", "rev-parse", "--verify", "--quiet", f"{rev}^{{commit}}"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    except FileNotFoundError:
+        return False
+    return proc.returncode == 0
+
+
+def toml_at(rev, path):
+    """Parsed TOML file at git revision rev, empty if it did not exist."""
+    proc = subprocess.run(
+        ["git", "show", f"{rev}:{path}"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    return tomli.loads(proc.stdout) if proc.returncode == 0 else {}
+
+
+def changed_keys(old, new):
+    return {k for k in old.keys() | new.keys() if old.get(k) != new.get(k)}
+
+
+def changed_images(rev, canonical_names, tags_file=None, tasks_file=None):
+    """Images whose files or entries in tags, tasks and images info changed.
+
+    Changes are taken from git diff with rev, including not committed changes
+    of tracked files. Untracked files are not taken, e.g. Dockerfiles rendered
+    to org by old versions of build.py. Tags and tasks files are compared only
+    if they are tracked. A changed task for all images changes all of them.
+    """
+    git_cmd = ["git", "diff", "--name-only", rev, "--"]
+    output = subprocess.run(git_cmd, stdout=subprocess.PIPE, check=True, text=True)
+    files = set(output.stdout.splitlines())
+
+    def tracked_path(path):
+        if path is None:
+            return None
+        try:
+            return Path(path).resolve().relative_to(Path.cwd().resolve()).as_posix()
+        except ValueError:
+            return None
+
+    changed = set()
+    for file in files:
+        parts = Path(file).parts
+        if len(parts) > 3 and parts[0] == ORG_DIR.name:
+            changed.add("/".join(parts[1:3]))
+
+    def current(path):
+        return tomli.loads(Path(path).read_text()) if Path(path).exists() else {}
+
+    for toml_file in [tracked_path(tags_file), "images-info.toml"]:
+        if toml_file in files:
+            changed |= changed_keys(toml_at(rev, toml_file), current(toml_file))
+    if (tasks_toml := tracked_path(tasks_file)) in files:
+        old, new = toml_at(rev, tasks_toml), current(tasks_toml)
+        for branch in changed_keys(old, new):
+            old_tasks, new_tasks = old.get(branch, {}), new.get(branch, {})
+            for task in changed_keys(old_tasks, new_tasks):
+                for images in [old_tasks.get(task), new_tasks.get(task)]:
+                    if images is None:
+                        continue
+                    changed |= set(images) if images else set(canonical_names)
+
+    return changed & set(canonical_names)
+
+
+def critical_paths(graph, costs):
+    """Return the longest cost of a path from every node of graph to the end.
+
+    Nodes with longer paths should be started first, the longest one is the
+    least time it takes to process the whole graph.
+    """
+    dependents = graph_dependents(graph)
+    paths = {}
+    for node in reversed(list(TopologicalSorter(graph).static_order())):
+        longest = max((paths[d] for d in dependents.get(node, [])), default=0)
+        paths[node] = costs.get(node, 0) + longest
+    return paths
+
+
+def positive_int(value):
+    """Parse a positive number of jobs."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid number {value}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive number")
+    return number
+
+
+def non_negative_int(value):
+    """Parse a number of retries, zero or more."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid number {value}")
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"{value} is a negative number")
+    return number
+
+
+def parse_shard(value):
+    """Parse K/N to (K, N) with 1 <= K <= N."""
+    try:
+        k, n = (int(i) for i in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard {value}, expected K/N")
+    if not 1 <= k <= n:
+        raise argparse.ArgumentTypeError(f"invalid shard {value}, 1 <= K <= N")
+    return k, n
+
+
+def shard_arches(arches, shard):
+    """Arches built by shard K of N, every arch is built by exactly one shard."""
+    k, n = shard
+    return set(sorted(arches)[k - 1 :: n])
+
+
+def run_graph(graph, action, jobs=1, priority=None):
+    """Call action for every node of graph after all its requirements are done.
+
+    Up to jobs nodes are processed at the same time, ready nodes with higher
+    priority first. On the first failure no new nodes are started, running ones
+    are waited for and the error is reraised.
+    """
+    ts = TopologicalSorter(graph)
+    ts.prepare()
+    ready = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        running = {}
+        error = None
+        while ts.is_active() and error is None:
+            ready.extend(ts.get_ready())
+            if priority is not None:
+                ready.sort(key=priority, reverse=True)
+            while ready and len(running) < jobs:
+                node = ready.pop(0)
+                running[executor.submit(action, node)] = node
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                node = running.pop(future)
+                if future.exception() is not None:
+                    error = error or future.exception()
+                else:
+                    ts.done(node)
+        concurrent.futures.wait(running)
+    if error is not None:
+        raise error
 
 
 class ImagesInfo:
@@ -636,13 +1844,12 @@ class ImagesInfo:
         return info.get("skip-branches", [])
 
 
-def parse_args():
-    stages = ["build", "remove_dockerfiles", "render_dockerfiles", "push"]
+def parse_args(catalog: ImageCatalog):
+    stages = ["build", "remove_dockerfiles", "render_dockerfiles", "push", "assemble"]
     arches = ["amd64", "386", "arm64", "arm", "ppc64le"]
     branches = ["p9", "p10", "sisyphus"]
-    organizations = list(ORG_DIR.iterdir())
-    images = [f"{o.name}/{i.name}" for o in organizations for i in o.iterdir()]
-    organizations = [o.name for o in organizations]
+    organizations = catalog.organizations
+    images = catalog.canonical_names
 
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -736,7 +1943,7 @@ def parse_args():
     parser.add_argument(
         "--stages",
         nargs="+",
-        default=stages,
+        default=[s for s in stages if s != "assemble"],
         choices=stages,
         help="list of stages",
     )
@@ -747,23 +1954,162 @@ def parse_args():
         choices=stages,
         help="list of skipping stages",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=positive_int,
+        default=1,
+        help="number of images to build in parallel",
+    )
+    parser.add_argument(
+        "--arch-jobs",
+        type=positive_int,
+        default=1,
+        help="number of arches of an image to build in parallel, if greater than 1 "
+        "each arch is built as a separate image and added to the manifest",
+    )
+    parser.add_argument(
+        "--build-cache",
+        action="store_true",
+        help="skip building images and distroless arches whose inputs did not "
+        "change since the last build",
+    )
+    parser.add_argument(
+        "--push-jobs",
+        type=positive_int,
+        default=1,
+        help="number of images to push in parallel, images are pushed while "
+        "other images are being built",
+    )
+    parser.add_argument(
+        "--push-retries",
+        type=non_negative_int,
+        default=2,
+        help="number of times to retry a failed push",
+    )
+    parser.add_argument(
+        "--insecure-registry",
+        action="store_true",
+        help="do not verify TLS of the registry, e.g. a local one over http",
+    )
+    parser.add_argument(
+        "--changed-since",
+        metavar="REV",
+        help="build only selected images changed since git revision REV and "
+        "images which require them",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        metavar="K/N",
+        help="build and push only the arches of shard K of N as separate images, "
+        "the assemble stage creates manifests of them",
+    )
+    parser.add_argument(
+        "--staging-organization",
+        metavar="ORGANIZATION",
+        help="organization to push arch images of shards to, the assemble stage "
+        "copies them to the organization of the images",
+    )
+    parser.add_argument(
+        "--arch-digests",
+        type=Path,
+        action="append",
+        metavar="FILE",
+        help="file with digests of arch images pushed by a shard, the assemble "
+        "stage reads the files of all shards, build/arch-digests.json if not given",
+    )
+    parser.add_argument(
+        "--plan",
+        type=Path,
+        default=BUILD_DIR / "plan.json",
+        help="write the resolved plan of images, their arches, tags, stages and "
+        "requires to PLAN, after the run a log of commands run for every image "
+        "is added, PLAN is only written for inspection and is never read",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip stages of images done by the last run of the same plan",
+    )
+    parser.add_argument(
+        "--trace",
+        type=Path,
+        metavar="FILE",
+        help="write a trace of stages and commands in Chrome trace event format "
+        "to FILE and a summary of times per image and arch next to it",
+    )
+    parser.add_argument(
+        "--apt-cache",
+        action="store_true",
+        help="keep apt lists and downloaded packages of Dockerfile images in "
+        "cache mounts shared between builds instead of removing them",
+    )
+    parser.add_argument(
+        "--apt-volume",
+        action="append",
+        default=[],
+        dest="apt_volumes",
+        metavar="VOLUME",
+        help="bind mount HOST-DIR:CONTAINER-DIR[:OPTIONS] into RUN steps of "
+        "Dockerfile images, e.g. a local mirror and its sources.list",
+    )
+    parser.add_argument(
+        "--warm-builders",
+        action="store_true",
+        help="add task repos and run apt-get update once per branch, arch and "
+        "tasks in a snapshot of the distroless builder and start builders of "
+        "distroless images from it",
+    )
     args = parser.parse_args()
 
     args.stages = set(args.stages) - set(args.skip_stages)
     args.arches = set(args.arches) - set(args.skip_arches)
     args.branches = set(args.branches) - set(args.skip_branches)
     args.images = set(args.images) - set(args.skip_images)
+    if args.shard is not None or "assemble" in args.stages:
+        if args.staging_organization is None:
+            parser.error("--shard and assemble stage require --staging-organization")
+        if args.staging_organization in [
+            *args.organizations,
+            args.overwrite_organization,
+        ]:
+            parser.error("--staging-organization must differ from organizations")
+    if args.shard is not None:
+        if "assemble" in args.stages:
+            parser.error("assemble stage is run after all shards without --shard")
+        args.arches = shard_arches(args.arches, args.shard)
+        if not args.arches:
+            parser.error(f"no arches left for shard {args.shard[0]}/{args.shard[1]}")
+        if args.arch_digests is not None and len(args.arch_digests) > 1:
+            parser.error("a shard stores digests to a single --arch-digests file")
+    if args.arch_digests is None:
+        args.arch_digests = [BUILD_DIR / "arch-digests.json"]
 
     return args
 
 
 def main():
-    args = parse_args()
+    catalog = ImageCatalog()
+    args = parse_args(catalog)
+    if args.changed_since is not None and not is_git_commit(args.changed_since):
+        sys.exit(f"Cannot select changed images: {args.changed_since} is not a commit")
     arches = args.arches
     images_info = ImagesInfo()
     tags = Tags(args.tags, args.latest)
+    if args.build_cache:
+        build_cache = BuildCache(BUILD_DIR / "cache" / "build-cache.json")
+    else:
+        build_cache = None
+    requires_cache = RequiresCache(BUILD_DIR / "cache" / "requires.json")
+    builder_pool = BuilderPool() if args.warm_builders else None
+    push_cache = PushCache(BUILD_DIR / "cache" / "push-cache.json")
+    tracer = Tracer()
+    history = DurationHistory(BUILD_DIR / "cache" / "durations.json")
+    arch_digests = ArchDigests(args.arch_digests)
+    builders = {}
     for organization in args.organizations:
-        for branch in args.branches:
+        for branch in sorted(args.branches):
             db = DockerBuilder(
                 args.registry,
                 branch,
@@ -774,24 +2120,144 @@ def main():
                 images_info,
                 args.tasks,
                 tags,
+                args.arch_jobs,
+                build_cache,
+                catalog,
+                requires_cache,
+                builder_pool,
+                args.apt_cache,
+                args.apt_volumes,
+                args.push_retries,
+                push_cache,
+                not args.insecure_registry,
+                tracer,
+                args.shard is not None,
+                arch_digests,
+                args.staging_organization,
             )
             if "remove_dockerfiles" in args.stages:
                 db.remove_dockerfiles()
             if "render_dockerfiles" in args.stages:
                 db.render_dockerfiles()
             db.load_distrolesses()
-            for image in db.get_build_order():
-                if image.canonical_name not in args.images:
-                    continue
+            builders[(organization, branch)] = db
+
+    # one graph for all branches and organizations, nodes are (branch, image)
+    requires = {}
+    for (organization, branch), db in builders.items():
+        for canonical_name, image_requires in db.get_requires_graph().items():
+            requires[(branch, canonical_name)] = {(branch, r) for r in image_requires}
+    requires_cache.save()
+    for node in requires:
+        # images out of the tree or not selected organizations are already built
+        requires[node] &= requires.keys()
+
+    if args.changed_since is not None:
+        changed = changed_images(
+            args.changed_since,
+            catalog.canonical_names,
+            args.tags,
+            args.tasks.tasks_file,
+        )
+        changed_nodes = {n for n in requires if n[1] in changed}
+        rebuilt = {n[1] for n in with_dependents(requires, changed_nodes)}
+        args.images &= rebuilt
+        print(
+            f"Changed since {args.changed_since}: "
+            f"{', '.join(sorted(changed)) or 'none'}, "
+            f"selected with dependents: {', '.join(sorted(args.images)) or 'none'}"
+        )
 
-                if "build" in args.stages:
-                    if image.canonical_name in db.distrolesses:
-                        db.distroless_build(image, arches)
-                    else:
-                        db.podman_build(image, arches)
+    plan = build_plan(requires, builders, args.images, args.stages, arches, images_info)
+    plan_nodes = {n["id"]: n for n in plan["nodes"]}
+    plan_graph = {n["id"]: set(n["requires"]) for n in plan["nodes"]}
+    try:
+        checkpoint = Checkpoint(
+            BUILD_DIR / "checkpoint.json",
+            plan_hash(plan),
+            args.resume,
+            args.dry_run,
+        )
+    except ValueError as e:
+        sys.exit(f"Cannot resume: {e}")
+    if args.resume:
+        print(f"Resume plan, {len(checkpoint)} stages are already done")
+    write_plan(args.plan, plan)
+
+    costs = {}
+    unknown = []
+    for node_id, node in plan_nodes.items():
+        if "build" not in node["stages"] or checkpoint.done(node_id, "build"):
+            continue
+        db = builders[(node["organization"], node["branch"])]
+        costs[node_id] = history.estimate(node_id, node["arches"], db.arch_jobs)
+        if costs[node_id] is None:
+            unknown.append(node_id)
+    known = sorted(c for c in costs.values() if c is not None)
+    for node_id in unknown:
+        # images without history take as long as a typical one
+        costs[node_id] = known[len(known) // 2] if known else 0
+    priorities = critical_paths(plan_graph, costs)
+    if len(unknown) < len(costs):
+        critical_path = max(priorities.values())
+        total = sum(costs.values())
+        estimate = max(critical_path, total / args.jobs)
+        print(
+            f"Estimated build time {datetime.timedelta(seconds=round(estimate))}: "
+            f"critical path {datetime.timedelta(seconds=round(critical_path))}, "
+            f"total {datetime.timedelta(seconds=round(total))} "
+            f"with {args.jobs} jobs, {len(unknown)} images without history"
+        )
+
+    def build_image(node_id):
+        node = plan_nodes[node_id]
+        image = Image(node["image"])
+        db = builders[(node["organization"], node["branch"])]
 
-                if "push" in args.stages:
-                    db.podman_push(image, args.sign)
+        if "build" in node["stages"] and not checkpoint.done(node_id, "build"):
+            if node["kind"] == "distroless":
+                db.distroless_build(image, node["arches"])
+            else:
+                db.podman_build(image, node["arches"])
+            checkpoint.mark(node_id, "build")
+
+        # pushed images are not needed to build other images
+        for stage in ["push", "assemble"]:
+            if stage in node["stages"] and not checkpoint.done(node_id, stage):
+                push_futures.append(push_executor.submit(push_image, node_id, stage))
+
+    def push_image(node_id, stage):
+        node = plan_nodes[node_id]
+        image = Image(node["image"])
+        db = builders[(node["organization"], node["branch"])]
+        if stage == "assemble":
+            db.assemble(image, node["arches"], args.sign)
+        elif args.shard is not None:
+            db.podman_push_arches(image, node["arches"], args.sign)
+        else:
+            db.podman_push(image, args.sign)
+        checkpoint.mark(node_id, stage)
+
+    push_futures = []
+    push_executor = concurrent.futures.ThreadPoolExecutor(args.push_jobs)
+    try:
+        with push_executor:
+            run_graph(plan_graph, build_image, args.jobs, priorities.get)
+        for future in push_futures:
+            future.result()
+    finally:
+        if builder_pool is not None and builders:
+            builder_pool.remove_all(next(iter(builders.values())).run)
+        if build_cache is not None:
+            build_cache.report()
+        if "push" in args.stages or "assemble" in args.stages:
+            push_cache.report()
+        if args.trace is not None:
+            tracer.save(args.trace)
+        write_plan(args.plan, plan, tracer)
+        if not args.dry_run:
+            history.update(tracer)
+            history.save()
 
 
 if __name__ == "__main__":
@@ -6,83 +6,441 @@ from pathlib import Path
 
 import argparse
 import glob
+import os
+import posixpath
 import re
+import struct
 import subprocess
+import sys
 import tarfile
 
 
+class Excluder:
+    """Match paths against exclude regexes like any(re.match(r, path)).
+
+    Regexes without special characters are plain prefixes and are checked with
+    str.startswith, all the others are compiled once into a single regex.
+    """
+
+    def __init__(self, regexes):
+        special = set(".^$*+?{}[]\\|()")
+        self.prefixes = tuple(r for r in regexes if not special & set(r))
+        others = [r for r in regexes if special & set(r)]
+        if not others:
+            self.regexes = []
+        else:
+            try:
+                self.regexes = [re.compile("|".join(f"(?:{r})" for r in others))]
+            except re.error:
+                # e.g. global flags which must be at the start of a regex
+                self.regexes = [re.compile(r) for r in others]
+
+    def __bool__(self):
+        return bool(self.prefixes or self.regexes)
+
+    def excluded(self, path):
+        name = "/" + path.lstrip("/")
+        return name.startswith(self.prefixes) or any(
+            r.match(name) for r in self.regexes
+        )
+
+
 class DL:
     def __init__(self, dl_file):
         self.dl_file = Path(dl_file)
 
-    def add(self, files, file_lists, packages, is_glob=True, follow_symlink=True):
-        def write(dl_file, file):
+    def files(
+        self,
+        files,
+        file_lists,
+        packages,
+        is_glob=True,
+        follow_symlink=True,
+        regexes=(),
+    ):
+        written = set()
+        excluder = Excluder(regexes)
+
+        def write_once(file):
+            if file not in written:
+                written.add(file)
+                if not (excluder and excluder.excluded(file)):
+                    yield file
+
+        def write(file):
             file = file.rstrip("\n")
-            dl_file.write(file + "\n")
+            yield from write_once(file)
             path = Path(file)
             if follow_symlink and path.is_symlink():
-                dl_file.write(path.resolve().as_posix() + "\n")
+                yield from write_once(path.resolve().as_posix())
 
-        def write_globs(is_glob, source, dl_file):
+        def write_globs(is_glob, source):
             if is_glob:
                 for file in glob.glob(source.rstrip("\n")):
-                    write(dl_file, file)
+                    yield from write(file)
             else:
-                write(dl_file, file)
+                yield from write(source)
 
+        for file in files:
+            yield from write_globs(is_glob, file)
+        for file_list in file_lists:
+            with open(file_list) as fl:
+                for line in fl:
+                    yield from write_globs(is_glob, line)
+        if packages:
+            proc = subprocess.run(["rpm", "-qls"] + packages, stdout=subprocess.PIPE)
+            proc.check_returncode()
+            for line in proc.stdout.decode().splitlines():
+                state, filename = line.split(maxsplit=1)
+                if state == "normal":
+                    yield from write(filename)
+
+    def add(
+        self,
+        files,
+        file_lists,
+        packages,
+        is_glob=True,
+        follow_symlink=True,
+        regexes=(),
+    ):
         with open(self.dl_file, "a") as dl_file:
-            for file in files:
-                write_globs(is_glob, file, dl_file)
-            for file_list in file_lists:
-                with open(file_list) as fl:
-                    for line in fl:
-                        write_globs(is_glob, line, dl_file)
-            for package in packages:
-                proc = subprocess.run(["rpm", "-qls", package], stdout=subprocess.PIPE)
-                proc.check_returncode()
-                for line in proc.stdout.decode().splitlines():
-                    state, filename = line.split(maxsplit=1)
-                    if state == "normal":
-                        write(dl_file, filename)
-
-    def tar(self, outfile, regexes):
+            for file in self.files(
+                files, file_lists, packages, is_glob, follow_symlink, regexes
+            ):
+                dl_file.write(file + "\n")
+
+    @staticmethod
+    def write_tar(tar, paths, regexes=(), reproducible=False):
+        """Add paths to tar, if reproducible the same files give the same archive.
+
+        In reproducible mode paths with their parent directories are sorted and
+        added once, mtimes are set to SOURCE_DATE_EPOCH (or 0) and owner names
+        are dropped, numeric owners are kept. Files with the same inode are
+        added as hard links to the first of them.
+        """
+        excluder = Excluder(regexes)
+        mtime = int(os.environ.get("SOURCE_DATE_EPOCH", 0))
+
         def filter(tarinfo):
-            name = f"/{tarinfo.name}"
-            if not any(re.match(r, name) for r in regexes):
-                return tarinfo
+            if excluder and excluder.excluded(tarinfo.name):
+                return None
+            if reproducible:
+                tarinfo.mtime = mtime
+                tarinfo.uname = tarinfo.gname = ""
+            return tarinfo
+
+        if reproducible:
+            unique_paths = set()
+            for path in paths:
+                path = posixpath.normpath(path)
+                while path not in unique_paths and path not in ["/", "."]:
+                    unique_paths.add(path)
+                    path = posixpath.dirname(path)
+            paths = sorted(unique_paths)
 
+        for path in paths:
+            tar.add(path, recursive=False, filter=filter)
+
+    def tar(self, outfile, regexes, reproducible=False):
         with tarfile.open(outfile, "w") as tar:
             with open(self.dl_file) as dl_file:
-                for path in dl_file:
-                    tar.add(path[:-1], recursive=False, filter=filter)
+                self.write_tar(tar, (p[:-1] for p in dl_file), regexes, reproducible)
+
+    def build(
+        self,
+        outfile,
+        files,
+        file_lists,
+        packages,
+        regexes,
+        is_glob=True,
+        follow_symlink=True,
+        reproducible=False,
+        skip_lists=(),
+        written_list=None,
+    ):
+        """Stream tar archive of the files without writing the dl-file.
+
+        Files listed in skip_lists, e.g. files of lower layers, are not added,
+        added files are listed in written_list.
+        """
+        skip = set()
+        for skip_list in skip_lists:
+            with open(skip_list) as sl:
+                skip.update(line.rstrip("\n") for line in sl)
+        paths = self.files(
+            files, file_lists, packages, is_glob, follow_symlink, regexes
+        )
+        if skip or written_list is not None:
+            paths = [p for p in paths if posixpath.normpath(p) not in skip]
+        if written_list is not None:
+            written_list = Path(written_list)
+            written_list.parent.mkdir(parents=True, exist_ok=True)
+            written_list.write_text(
+                "".join(posixpath.normpath(p) + "\n" for p in paths)
+            )
+        with tarfile.open(fileobj=outfile, mode="w|") as tar:
+            self.write_tar(tar, paths, regexes, reproducible)
 
     def clean(self):
         self.dl_file.unlink(missing_ok=True)
 
 
-def library_files(binaries):
-    files = set()
-    for binary in binaries:
-        ldd = subprocess.run(["ldd", binary], stdout=subprocess.PIPE)
-        ldd.check_returncode()
-        for line in ldd.stdout.decode().splitlines():
-            if match := re.match(r".*=>\s*(?P<file>\S+)", line):
-                files.add(match.groupdict()["file"])
+class ELF:
+    """Dynamic section of an ELF file: DT_NEEDED, DT_RPATH and DT_RUNPATH."""
 
-    return list(files)
+    PT_LOAD = 1
+    PT_DYNAMIC = 2
+    DT_NEEDED = 1
+    DT_STRTAB = 5
+    DT_RPATH = 15
+    DT_RUNPATH = 29
 
+    def __init__(self, path):
+        self.needed = []
+        self.rpath = []
+        self.runpath = []
+        with open(path, "rb") as elf:
+            ident = elf.read(16)
+            if len(ident) < 16 or ident[:4] != b"\x7fELF":
+                raise ValueError(f"{path} is not an ELF file")
+            self.elf_class = ident[4]
+            self.elf_data = ident[5]
+            order = "<" if self.elf_data == 1 else ">"
+            if self.elf_class == 1:
+                header_format, phdr_format, dyn_format = "HHIIIIIHHHHHH", "8I", "iI"
+            else:
+                header_format, phdr_format, dyn_format = (
+                    "HHIQQQIHHHHHH",
+                    "IIQQQQQQ",
+                    "qQ",
+                )
+            header_format, phdr_format, dyn_format = (
+                order + f for f in (header_format, phdr_format, dyn_format)
+            )
+            header = struct.unpack(
+                header_format, elf.read(struct.calcsize(header_format))
+            )
+            self.machine = header[1]
+            phoff, phentsize, phnum = header[4], header[8], header[9]
 
-def library_packages(binaries):
-    packages = set()
-    for file in library_files(binaries):
-        rpm = subprocess.run(
-            ["rpm", "-qf", file, "--queryformat", r"%{NAME}\n"],
-            stdout=subprocess.PIPE,
+            loads = []
+            dynamic = None
+            for i in range(phnum):
+                elf.seek(phoff + i * phentsize)
+                phdr = struct.unpack(
+                    phdr_format, elf.read(struct.calcsize(phdr_format))
+                )
+                if self.elf_class == 1:
+                    p_type, p_offset, p_vaddr, _, p_filesz = phdr[:5]
+                else:
+                    p_type, _, p_offset, p_vaddr, _, p_filesz = phdr[:6]
+                if p_type == self.PT_LOAD:
+                    loads.append((p_vaddr, p_offset, p_filesz))
+                elif p_type == self.PT_DYNAMIC:
+                    dynamic = (p_offset, p_filesz)
+            if dynamic is None:
+                return
+
+            elf.seek(dynamic[0])
+            data = elf.read(dynamic[1])
+            entries = []
+            strtab = None
+            for tag, value in struct.iter_unpack(dyn_format, data):
+                if tag == 0:
+                    break
+                if tag == self.DT_STRTAB:
+                    strtab = value
+                entries.append((tag, value))
+            if strtab is None:
+                return
+            for vaddr, offset, filesz in loads:
+                if vaddr <= strtab < vaddr + filesz:
+                    strtab = strtab - vaddr + offset
+                    break
+
+            def string(value):
+                elf.seek(strtab + value)
+                chunk = b""
+                while b"\0" not in chunk:
+                    if not (read := elf.read(256)):
+                        break
+                    chunk += read
+                return chunk.split(b"\0", 1)[0].decode()
+
+            for tag, value in entries:
+                if tag == self.DT_NEEDED:
+                    self.needed.append(string(value))
+                elif tag == self.DT_RPATH:
+                    self.rpath += string(value).split(":")
+                elif tag == self.DT_RUNPATH:
+                    self.runpath += string(value).split(":")
+
+    def compatible(self, other):
+        return (self.elf_class, self.elf_data, self.machine) == (
+            other.elf_class,
+            other.elf_data,
+            other.machine,
         )
-        rpm.check_returncode()
-        packages.add(rpm.stdout.decode().strip())
 
-    return list(packages)
+
+class LibraryResolver:
+    """Resolve shared libraries of binaries like ld.so does, without running it.
+
+    Paths are looked up in root, so binaries of another arch could be resolved
+    on the host against a target root. Returned paths are relative to root.
+    """
+
+    def __init__(self, root="/"):
+        self.root = root
+        self._elfs = {}
+        self._found = {}
+        self._ld_so_cache = None
+
+    def real_path(self, path):
+        """Path in the host file system, symlinks are resolved inside root."""
+        return os.path.join(self.root, self.resolve(path).lstrip("/"))
+
+    def resolve(self, path):
+        """Path with all symlinks resolved inside root."""
+        if self.root == "/":
+            return os.path.realpath(path)
+        parts = [p for p in path.split("/") if p]
+        resolved = "/"
+        links = 0
+        while parts:
+            part = parts.pop(0)
+            candidate = posixpath.join(resolved, part)
+            host_path = os.path.join(self.root, candidate.lstrip("/"))
+            if os.path.islink(host_path):
+                links += 1
+                if links > 40:
+                    raise OSError(f"too many levels of symbolic links in {path}")
+                target = os.readlink(host_path)
+                if not target.startswith("/"):
+                    target = posixpath.join(resolved, target)
+                parts = [p for p in target.split("/") if p] + parts
+                resolved = "/"
+            elif part == "..":
+                resolved = posixpath.dirname(resolved)
+            elif part != ".":
+                resolved = candidate
+        return resolved
+
+    def elf(self, path):
+        if path not in self._elfs:
+            try:
+                self._elfs[path] = ELF(self.real_path(path))
+            except (OSError, ValueError, struct.error):
+                self._elfs[path] = None
+        return self._elfs[path]
+
+    def ld_so_cache(self):
+        if self._ld_so_cache is None:
+            self._ld_so_cache = {}
+            try:
+                with open(self.real_path("/etc/ld.so.cache"), "rb") as cache:
+                    data = cache.read()
+            except OSError:
+                return self._ld_so_cache
+            offset = data.find(b"glibc-ld.so.cache1.1")
+            if offset < 0:
+                return self._ld_so_cache
+            for order in "<>":
+                nlibs, len_strings = struct.unpack_from(order + "II", data, offset + 20)
+                if offset + 48 + nlibs * 24 + len_strings <= len(data):
+                    break
+
+            def string(start):
+                # string offsets are relative to the beginning of the new format
+                start += offset
+                return data[start : data.index(b"\0", start)].decode()
+
+            for i in range(nlibs):
+                _, key, value = struct.unpack_from(
+                    order + "iII", data, offset + 48 + i * 24
+                )
+                self._ld_so_cache.setdefault(string(key), []).append(string(value))
+        return self._ld_so_cache
+
+    def expand(self, path, origin, elf):
+        lib = "lib64" if elf.elf_class == 2 else "lib"
+        for name, value in [("ORIGIN", origin), ("LIB", lib)]:
+            path = path.replace(f"${{{name}}}", value).replace(f"${name}", value)
+        return path
+
+    def find(self, name, elf, dirs):
+        if "/" in name:
+            return name if self.elf(name) else None
+        key = (name, dirs, elf.elf_class, elf.elf_data, elf.machine)
+        if key in self._found:
+            return self._found[key]
+        candidates = [posixpath.join(d, name) for d in dirs]
+        candidates += self.ld_so_cache().get(name, [])
+        candidates += [
+            posixpath.join(d, name)
+            for d in ["/lib64", "/usr/lib64", "/lib", "/usr/lib"]
+        ]
+        self._found[key] = None
+        for candidate in candidates:
+            if (other := self.elf(candidate)) is not None and elf.compatible(other):
+                self._found[key] = candidate
+                break
+        return self._found[key]
+
+    def dependencies(self, binary):
+        """Libraries in the order ld.so loads them, breadth-first by soname."""
+        loaded = {}
+        queue = [(binary, self.elf(binary), ())]
+        while queue:
+            path, elf, inherited_rpath = queue.pop(0)
+            origin = posixpath.dirname(self.resolve(path))
+            runpath = tuple(self.expand(p, origin, elf) for p in elf.runpath if p)
+            if runpath:
+                # RUNPATH disables RPATH of the object and of its loaders
+                dirs = runpath
+                rpath = inherited_rpath
+            else:
+                rpath = tuple(self.expand(p, origin, elf) for p in elf.rpath if p)
+                dirs = rpath = rpath + inherited_rpath
+            for name in elf.needed:
+                if name in loaded:
+                    continue
+                library = self.find(name, elf, dirs)
+                if library is None:
+                    raise FileNotFoundError(f"{name} needed by {path} is not found")
+                loaded[name] = library
+                queue.append((library, self.elf(library), rpath))
+        return list(loaded.values())
+
+    def library_files(self, binaries):
+        files = {}
+        for binary in binaries:
+            # missing and unreadable binaries are errors, files which are not
+            # ELF are skipped, static ELF files have no libraries
+            try:
+                self._elfs[binary] = ELF(self.real_path(binary))
+            except (ValueError, struct.error):
+                continue
+            files.update(dict.fromkeys(self.dependencies(binary)))
+        return list(files)
+
+
+def library_files(binaries, root="/"):
+    return LibraryResolver(root).library_files(binaries)
+
+
+def library_packages(binaries):
+    if not (files := library_files(binaries)):
+        return []
+    rpm = subprocess.run(
+        ["rpm", "-qf", "--queryformat", r"%{NAME}\n"] + files,
+        stdout=subprocess.PIPE,
+    )
+    rpm.check_returncode()
+
+    return list(set(rpm.stdout.decode().split()))
 
 
 def parse_args():
@@ -93,62 +451,81 @@ def parse_args():
         "--dl-file",
         default="dl-file.list",
     )
-    subparsers = parser.add_subparsers(dest="subparser_name")
-    parser_add = subparsers.add_parser("add", help="add files to the dl-file")
-    parser_add.add_argument(
+    parser_files = argparse.ArgumentParser(add_help=False)
+    parser_files.add_argument(
         "--noglob",
         action="store_false",
         default=True,
         dest="glob",
         help="do not expand file names as globs",
     )
-    parser_add.add_argument(
+    parser_files.add_argument(
         "--no-follow-symlink",
         action="store_false",
         default=True,
         dest="follow_symlink",
         help="do not add symlink destination with symlink",
     )
-    parser_add.add_argument(
-        "--clean",
-        action="store_true",
-        help="clean before add",
-    )
-    parser_add.add_argument(
+    parser_files.add_argument(
         "-f",
         "--files",
         nargs="+",
         default=[],
         help="adding files to the dl-file",
     )
-    parser_add.add_argument(
+    parser_files.add_argument(
         "-l",
         "--file-lists",
         nargs="+",
         default=[],
         help="adding file from file lists to the dl-file",
     )
-    parser_add.add_argument(
+    parser_files.add_argument(
         "--library-files",
         nargs="+",
         default=[],
         help="adding library files for binaries to the the dl-file",
     )
-    parser_add.add_argument(
+    parser_files.add_argument(
         "--library-packages",
         nargs="+",
         default=[],
         help="adding library packages for binaries to the the dl-file",
     )
-    parser_add.add_argument(
+    parser_files.add_argument(
         "-p",
         "--packages",
         nargs="+",
         default=[],
         help="adding file from packages to the dl-file",
     )
+    parser_regexes = argparse.ArgumentParser(add_help=False)
+    parser_regexes.add_argument(
+        "-r",
+        "--regexes",
+        nargs="+",
+        default=[],
+        help="list of regexes, any match exclude",
+    )
+    parser_reproducible = argparse.ArgumentParser(add_help=False)
+    parser_reproducible.add_argument(
+        "--reproducible",
+        action="store_true",
+        help="sorted and deduplicated archive with normalized mtimes and owners",
+    )
+    subparsers = parser.add_subparsers(dest="subparser_name")
+    parser_add = subparsers.add_parser(
+        "add", parents=[parser_files, parser_regexes], help="add files to the dl-file"
+    )
+    parser_add.add_argument(
+        "--clean",
+        action="store_true",
+        help="clean before add",
+    )
     parser_tar = subparsers.add_parser(
-        "tar", help="create tar archive from the dl-file"
+        "tar",
+        parents=[parser_regexes, parser_reproducible],
+        help="create tar archive from the dl-file",
     )
     parser_tar.add_argument(
         "-o",
@@ -156,14 +533,31 @@ def parse_args():
         help="path of the tar archive",
         default="distroless.tar",
     )
-    parser_tar.add_argument(
-        "-r",
-        "--regexes",
+    parser_build = subparsers.add_parser(
+        "build",
+        parents=[parser_files, parser_regexes, parser_reproducible],
+        help="write tar archive of the files to stdout without the dl-file",
+    )
+    parser_build.add_argument(
+        "--skip-lists",
         nargs="+",
         default=[],
-        help="list of regexes, any match exclude",
+        help="do not add files listed in these lists",
+    )
+    parser_build.add_argument(
+        "--written-list",
+        help="write list of added files to this file",
     )
     subparsers.add_parser("clean", help="remove the dl-file")
+    parser_library_files = subparsers.add_parser(
+        "library-files", help="print library files of binaries"
+    )
+    parser_library_files.add_argument(
+        "--root",
+        default="/",
+        help="resolve library files of binaries in this root directory",
+    )
+    parser_library_files.add_argument("binaries", nargs="+")
     args = parser.parse_args()
 
     return args
@@ -181,11 +575,28 @@ def main():
             args.packages + library_packages(args.library_packages),
             args.glob,
             args.follow_symlink,
+            args.regexes,
         )
     elif args.subparser_name == "tar":
-        dl.tar(args.outfile, args.regexes)
+        dl.tar(args.outfile, args.regexes, args.reproducible)
+    elif args.subparser_name == "build":
+        dl.build(
+            sys.stdout.buffer,
+            args.files + library_files(args.library_files),
+            args.file_lists,
+            args.packages + library_packages(args.library_packages),
+            args.regexes,
+            args.glob,
+            args.follow_symlink,
+            args.reproducible,
+            args.skip_lists,
+            args.written_list,
+        )
     elif args.subparser_name == "clean":
         dl.clean()
+    elif args.subparser_name == "library-files":
+        for file in library_files(args.binaries, args.root):
+            print(file)
 
 
 if __name__ == "__main__":